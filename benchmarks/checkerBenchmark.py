@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import ipaddress
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from time import time
+
+# Every simulated proxy is its own loopback address, so one listening socket
+# per protocol stands in for tens of thousands of endpoints
+first_address = int(ipaddress.ip_address("127.1.0.1"))
+
+target_port = 18180
+proxy_ports = {"http": 18181, "socks4": 18182, "socks5": 18183}
+# Nothing listens here, so connecting to it is refused
+refused_port = 18189
+# Seconds the fake proxies get to start listening
+startup_timeout = 30
+
+checker = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "proxyChecker.py")
+
+
+def set_ports(base_port):
+    # Every port the benchmark uses sits at a fixed offset from the target's
+    global target_port, proxy_ports, refused_port
+    target_port = base_port
+    proxy_ports = {"http": base_port + 1, "socks4": base_port + 2, "socks5": base_port + 3}
+    refused_port = base_port + 9
+
+
+def endpoint_address(index):
+    return str(ipaddress.ip_address(first_address + index))
+
+
+def endpoint_behaviour(address, seed, blackhole_rate, refuse_rate, fail_rate, clustered=False):
+    # Derived from the address alone, so the server and the harness agree without sharing state.
+    # Clustered endpoints behave like the rest of their /24, as provider ranges tend to
+    if clustered:
+        address = address.rsplit(".", 1)[0]
+    rate = random.Random(f"{seed}:{address}").random()
+    if rate < blackhole_rate:
+        return "blackhole"
+    rate -= blackhole_rate
+    if rate < refuse_rate:
+        return "refuse"
+    rate -= refuse_rate
+    if rate < fail_rate:
+        return "fail"
+    return "ok"
+
+
+def build_endpoints(count, seed, blackhole_rate, refuse_rate, fail_rate, clustered=False):
+    # Returns (proxy line, expected to pass) pairs with protocols spread evenly
+    protocols = list(proxy_ports)
+    endpoints = []
+    for index in range(count):
+        address = endpoint_address(index)
+        protocol = protocols[index % len(protocols)]
+        behaviour = endpoint_behaviour(address, seed, blackhole_rate, refuse_rate, fail_rate, clustered)
+        port = refused_port if behaviour == "refuse" else proxy_ports[protocol]
+        endpoints.append((f"{protocol}://{address}:{port}", behaviour == "ok"))
+    return endpoints
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+class FakeProxies:
+    # Local HTTP CONNECT, SOCKS4 and SOCKS5 proxies in front of a local target
+
+    def __init__(self, seed, latency, blackhole_rate, refuse_rate, fail_rate, clustered=False, subnet_capacity=None):
+        self.seed = seed
+        self.latency = latency
+        self.blackhole_rate = blackhole_rate
+        self.refuse_rate = refuse_rate
+        self.fail_rate = fail_rate
+        self.clustered = clustered
+        self.subnet_capacity = subnet_capacity
+        self.active = {}
+
+    def limited(self, handler):
+        # Past `subnet_capacity` open connections a /24 rejects requests, like a rate-limiting provider
+        async def serve(reader, writer):
+            subnet = writer.get_extra_info("sockname")[0].rsplit(".", 1)[0]
+            self.active[subnet] = self.active.get(subnet, 0) + 1
+            try:
+                overloaded = self.subnet_capacity is not None and self.active[subnet] > self.subnet_capacity
+                await handler(reader, writer, overloaded)
+            finally:
+                self.active[subnet] -= 1
+        return serve
+
+    async def behave(self, reader, writer, overloaded):
+        # Sleeps out the configured latency and tells whether the endpoint should work
+        if overloaded:
+            return False
+        address = writer.get_extra_info("sockname")[0]
+        behaviour = endpoint_behaviour(address, self.seed, self.blackhole_rate, self.refuse_rate, self.fail_rate,
+                                       self.clustered)
+        if behaviour == "blackhole":
+            # Silent until the checker gives up and hangs up
+            await reader.read()
+            return False
+        if self.latency:
+            await asyncio.sleep(random.uniform(0, 2 * self.latency))
+        return behaviour == "ok"
+
+    async def target(self, reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def tunnel(self, reader, writer):
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(pipe(reader, target_writer), pipe(target_reader, writer))
+
+    async def http(self, reader, writer, overloaded):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            ok = await self.behave(reader, writer, overloaded)
+            if not ok:
+                writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+                writer.close()
+                return
+            if head.startswith(b"CONNECT "):
+                writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+                await writer.drain()
+                await self.tunnel(reader, writer)
+            else:
+                target_reader, target_writer = await asyncio.open_connection("127.0.0.1", target_port)
+                target_writer.write(head)
+                await asyncio.gather(pipe(reader, target_writer), pipe(target_reader, writer))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+
+    async def socks4(self, reader, writer, overloaded):
+        try:
+            request = await reader.readexactly(8)
+            await reader.readuntil(b"\x00")
+            if request[4:7] == b"\x00\x00\x00":
+                await reader.readuntil(b"\x00")
+            ok = await self.behave(reader, writer, overloaded)
+            writer.write(b"\x00" + (b"\x5a" if ok else b"\x5b") + bytes(6))
+            await writer.drain()
+            if ok:
+                await self.tunnel(reader, writer)
+            else:
+                writer.close()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+
+    async def socks5(self, reader, writer, overloaded):
+        try:
+            header = await reader.readexactly(2)
+            await reader.readexactly(header[1])
+            writer.write(b"\x05\x00")
+            await writer.drain()
+            request = await reader.readexactly(4)
+            if request[3] == 1:
+                await reader.readexactly(4)
+            elif request[3] == 3:
+                await reader.readexactly((await reader.readexactly(1))[0])
+            else:
+                await reader.readexactly(16)
+            await reader.readexactly(2)
+            ok = await self.behave(reader, writer, overloaded)
+            writer.write(b"\x05" + (b"\x00" if ok else b"\x05") + b"\x00\x01" + bytes(6))
+            await writer.drain()
+            if ok:
+                await self.tunnel(reader, writer)
+            else:
+                writer.close()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+
+    async def serve(self, ready):
+        await asyncio.start_server(self.target, "127.0.0.1", target_port, backlog=4096)
+        for protocol, port in proxy_ports.items():
+            await asyncio.start_server(self.limited(getattr(self, protocol)), "0.0.0.0", port, backlog=4096)
+        ready.set()
+        await asyncio.Event().wait()
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_servers(ready, seed, latency, blackhole_rate, refuse_rate, fail_rate, clustered, subnet_capacity,
+                base_port=None):
+    if base_port is not None:
+        set_ports(base_port)
+    raise_file_limit()
+    asyncio.run(FakeProxies(seed, latency, blackhole_rate, refuse_rate, fail_rate, clustered,
+                            subnet_capacity).serve(ready))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark proxyChecker against local fake proxies")
+    parser.add_argument("-n", "--endpoints", type=int, help="Number of simulated proxies", default=20000)
+    parser.add_argument("-c", "--concurrency", help="Checker concurrency, a number or auto", default="auto")
+    parser.add_argument("-w", "--workers", type=int, help="Checker worker processes", default=1)
+    parser.add_argument("-t", "--timeout", type=float, help="Checker timeout in seconds", default=2)
+    parser.add_argument("--latency", type=float, help="Mean added latency per proxy in seconds", default=0.05)
+    parser.add_argument("--blackhole-rate", type=float, help="Share of proxies that never answer", default=0.05)
+    parser.add_argument("--refuse-rate", type=float, help="Share of proxies that refuse connections", default=0.2)
+    parser.add_argument("--fail-rate", type=float, help="Share of proxies that reject requests", default=0.25)
+    parser.add_argument("--seed", help="Seed choosing which proxies misbehave", default="0")
+    parser.add_argument("--clustered", help="Make every /24 behave as one, like provider ranges", action="store_true")
+    parser.add_argument("--subnet-capacity", type=int, help="Open connections per /24 past which requests fail")
+    parser.add_argument("--base-port", type=int, help="First of the local ports the fake proxies listen on",
+                        default=target_port)
+    parser.add_argument(
+        "checker_args",
+        nargs=argparse.REMAINDER,
+        help="Extra proxyChecker arguments, after --",
+    )
+    args = parser.parse_args()
+    set_ports(args.base_port)
+
+    endpoints = build_endpoints(args.endpoints, args.seed, args.blackhole_rate, args.refuse_rate, args.fail_rate,
+                                args.clustered)
+    expected = {line for line, ok in endpoints if ok}
+
+    ready = multiprocessing.Event()
+    servers = multiprocessing.Process(
+        target=run_servers,
+        args=(ready, args.seed, args.latency, args.blackhole_rate, args.refuse_rate, args.fail_rate, args.clustered,
+              args.subnet_capacity, args.base_port),
+        daemon=True,
+    )
+    servers.start()
+    deadline = time() + startup_timeout
+    while not ready.wait(0.1):
+        # A port that is already taken kills the server process before it is ready
+        if not servers.is_alive():
+            sys.exit(f"Fake proxies exited with code {servers.exitcode}; if ports {target_port}-{refused_port} "
+                     f"are in use, pick others with --base-port")
+        if time() > deadline:
+            servers.terminate()
+            sys.exit(f"Fake proxies did not start listening within {startup_timeout} seconds")
+
+    raise_file_limit()
+    with tempfile.TemporaryDirectory() as directory:
+        proxy_list = os.path.join(directory, "proxies.txt")
+        output = os.path.join(directory, "valid.txt")
+        with open(proxy_list, "w") as f:
+            f.write("\n".join(line for line, _ in endpoints))
+        command = [
+            sys.executable, checker,
+            "-l", proxy_list,
+            "-o", output,
+            "-p", "auto",
+            "-s", f"http://127.0.0.1:{target_port}/",
+            "-t", str(args.timeout),
+            "-c", str(args.concurrency),
+            "-w", str(args.workers),
+        ] + [arg for arg in args.checker_args if arg != "--"]
+        start = time()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time() - start
+        with open(output) as f:
+            found = {line.strip() for line in f if line.strip()}
+    # ru_maxrss of children is the largest among them, in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    servers.terminate()
+
+    true_positives = len(found & expected)
+    print(f"Endpoints:       {len(endpoints)} ({len(expected)} working)")
+    print(f"Elapsed:         {elapsed:.2f}s")
+    print(f"Checks/sec:      {len(endpoints) / elapsed:.1f}")
+    print(f"Peak memory:     {peak / 1024:.1f} MiB")
+    print(f"Found:           {len(found)}")
+    print(f"False positives: {len(found - expected)}")
+    print(f"False negatives: {len(expected - found)}")
+    print(f"Accuracy:        {(len(endpoints) - len(found ^ expected)) / len(endpoints):.2%}")
+    print(f"Precision:       {true_positives / len(found):.2%}" if found else "Precision:       -")
+    print(f"Recall:          {true_positives / len(expected):.2%}" if expected else "Recall:          -")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import os
+import random
+import sys
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxyScraper import GeneralDivScraper, GeneralTableScraper, TableScraper  # noqa: E402
+
+# Page furniture around the list, as on the real sites: navigation, inline scripts and a second table
+header = ("<!DOCTYPE html><html><head><title>Free Proxy List</title>"
+          "<script>window.dataLayer = window.dataLayer || []; function gtag(){dataLayer.push(arguments);}</script>"
+          "<style>.table td { padding: 4px; }</style></head><body>"
+          + "".join(f"<nav><ul><li><a href='/page/{i}'>Page {i}</a></li></ul></nav>" for i in range(40)))
+footer = ("<table class='footer'><tr><td>About</td><td>Contact</td></tr></table>"
+          + "<p>" + "Lorem ipsum dolor sit amet. " * 200 + "</p></body></html>")
+
+
+def random_proxy(rng):
+    return ".".join(str(rng.randint(1, 254)) for _ in range(4)), str(rng.randint(1, 65535))
+
+
+def table_page(rng, rows, class_name="table table-striped table-bordered", split=True):
+    body = [f"<table class='{class_name}'><thead><tr><th>IP Address</th><th>Port</th><th>Code</th>"
+            "<th>Country</th><th>Anonymity</th><th>Google</th><th>Https</th><th>Last Checked</th></tr></thead><tbody>"]
+    for _ in range(rows):
+        ip, port = random_proxy(rng)
+        first = f"<td>{ip}</td><td>{port}</td>" if split else f"<td><a href='/ip/{ip}'>{ip}:{port}</a></td><td>-</td>"
+        body.append(f"<tr>{first}<td>US</td><td class='hm'>United States</td><td>elite proxy</td>"
+                    f"<td class='hm'>no</td><td class='hx'>yes</td><td class='hm'>{rng.randint(1, 59)} secs ago</td></tr>")
+    body.append("</tbody></table>")
+    return header + "".join(body) + footer
+
+
+def div_page(rng, rows):
+    body = ["<div class='list'>"]
+    for _ in range(rows):
+        ip, port = random_proxy(rng)
+        body.append(f"<div class='tr'><div class='td'>{ip}</div><div class='td'>{port}</div>"
+                    "<div class='td'>HTTP</div><div class='td'><span class='flag'></span>US</div></div>")
+    body.append("</div>")
+    return header + "".join(body) + footer
+
+
+# What the scrapers did before, a BeautifulSoup tree per page
+
+def soup_general_table(text):
+    soup = BeautifulSoup(text, "html.parser")
+    proxies = set()
+    table = soup.find("table", attrs={"class": "table table-striped table-bordered"})
+    for row in table.find_all("tr"):
+        count = 0
+        proxy = ""
+        for cell in row.find_all("td"):
+            if count == 1:
+                proxy += ":" + cell.text.replace("&nbsp;", "")
+                proxies.add(proxy)
+                break
+            proxy += cell.text.replace("&nbsp;", "")
+            count += 1
+    return "\n".join(proxies)
+
+
+def soup_general_div(text):
+    soup = BeautifulSoup(text, "html.parser")
+    proxies = set()
+    table = soup.find("div", attrs={"class": "list"})
+    for row in table.find_all("div"):
+        count = 0
+        proxy = ""
+        for cell in row.find_all("div", attrs={"class": "td"}):
+            if count == 2:
+                break
+            proxy += cell.text+":"
+            count += 1
+        proxy = proxy.rstrip(":")
+        proxies.add(proxy)
+    return "\n".join(proxies)
+
+
+def soup_first_table(text):
+    soup = BeautifulSoup(text, "html.parser")
+    proxies = set()
+    table = soup.find("table")
+    for row in table.find_all("tr"):
+        cells = row.find_all("td")
+        if len(cells) > 0:
+            proxy = cells[0].text.strip()
+            proxies.add(proxy)
+    return "\n".join(proxies)
+
+
+def soup_parse(handle, body):
+    return {proxy.decode() for proxy in TableScraper.pattern.findall(handle(body.decode()).encode())}
+
+
+def scan_parse(scraper, body, chunk_size):
+    scanner = scraper.scanner(None)
+    proxies = set()
+    for start in range(0, len(body), chunk_size):
+        proxies.update(scanner.feed(body[start:start + chunk_size]))
+    proxies.update(scanner.close())
+    return proxies
+
+
+def timed(function, pages):
+    start = perf_counter()
+    results = [function(page) for page in pages]
+    return (perf_counter() - start) / len(pages), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HTML table extraction against BeautifulSoup")
+    parser.add_argument("-r", "--rows", type=int, help="Proxies per page", default=300)
+    parser.add_argument("-n", "--pages", type=int, help="Pages parsed per layout", default=30)
+    parser.add_argument("--chunk-size", type=int, help="Bytes fed to the scanner at a time", default=16384)
+    parser.add_argument("--seed", type=int, help="Seed for the generated pages", default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    layouts = [
+        ("General table", GeneralTableScraper("http", ""), soup_general_table, lambda: table_page(rng, args.rows)),
+        ("General div", GeneralDivScraper("http", ""), soup_general_div, lambda: div_page(rng, args.rows)),
+        ("First table", TableScraper("http", ""), soup_first_table,
+         lambda: table_page(rng, args.rows, class_name="proxies", split=False)),
+    ]
+    print(f"{'Layout':<15}{'Page KiB':>10}{'Soup ms':>10}{'Scan ms':>10}{'Speedup':>10}  Same result")
+    for name, scraper, handle, build in layouts:
+        pages = [build().encode() for _ in range(args.pages)]
+        soup_time, soup_results = timed(lambda page: soup_parse(handle, page), pages)
+        scan_time, scan_results = timed(lambda page: scan_parse(scraper, page, args.chunk_size), pages)
+        same = all(a == b for a, b in zip(soup_results, scan_results))
+        size = sum(len(page) for page in pages) / len(pages) / 1024
+        print(f"{name:<15}{size:>10.1f}{soup_time * 1000:>10.2f}{scan_time * 1000:>10.2f}"
+              f"{soup_time / scan_time:>9.1f}x  {'yes' if same else 'NO'}")
+
+
+if __name__ == "__main__":
+    main()
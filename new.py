@@ -1,34 +1,15 @@
 import argparse
 import asyncio
+import os
 import platform
-import re
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import httpx
-from bs4 import BeautifulSoup
 
-
-class Scraper:
-
-    def __init__(self, method, _url):
-        self.method = method
-        self._url = _url
-
-    def get_url(self, **kwargs):
-        return self._url.format(**kwargs, method=self.method)
-
-    async def get_response(self, client):
-        return await client.get(self.get_url())
-
-    async def handle(self, response):
-        return response.text
-
-    async def scrape(self, client):
-        response = await self.get_response(client)
-        proxies = await self.handle(response)
-        pattern = re.compile(r"\d{1,3}(?:\.\d{1,3}){3}(?::\d{1,5})?")
-        return re.findall(pattern, proxies)
+from proxyScraper import (GeneralDivScraper, GeneralTableScraper, GitHubScraper, ResponseCache, Scraper, Sources,
+                          TableScraper)
 
 
 # From spys.me
@@ -87,59 +68,8 @@ class ProxyListDownloadScraper(Scraper):
         return super().get_url(anon=self.anon, **kwargs)
 
 
-# For websites using table in html
-class GeneralTableScraper(Scraper):
-
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table", attrs={"class": "table table-striped table-bordered"})
-        for row in table.findAll("tr"):
-            count = 0
-            proxy = ""
-            for cell in row.findAll("td"):
-                if count == 1:
-                    proxy += ":" + cell.text.replace("&nbsp;", "")
-                    proxies.add(proxy)
-                    break
-                proxy += cell.text.replace("&nbsp;", "")
-                count += 1
-        return "\n".join(proxies)
-
-
-# For websites using div in html
-class GeneralDivScraper(Scraper):
-
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("div", attrs={"class": "list"})
-        for row in table.findAll("div"):
-            count = 0
-            proxy = ""
-            for cell in row.findAll("div", attrs={"class": "td"}):
-                if count == 2:
-                    break
-                proxy += cell.text+":"
-                count += 1
-            proxy = proxy.rstrip(":")
-            proxies.add(proxy)
-        return "\n".join(proxies)
-    
-# For scraping live proxylist from github
-class GitHubScraper(Scraper):
-        
-    async def handle(self, response):
-        tempproxies = response.text.split("\n")
-        proxies = set()
-        for prxy in tempproxies:
-            if self.method in prxy:
-                proxies.add(prxy.split("//")[-1])
-
-        return "\n".join(proxies)
-
 # From proxydb.net
-class ProxyDBScraper(Scraper):
+class ProxyDBScraper(TableScraper):
 
     def __init__(self, method, limit=15):
         self.limit = limit
@@ -148,22 +78,10 @@ class ProxyDBScraper(Scraper):
     def get_url(self, offset=0, **kwargs):
         return super().get_url(offset=offset, **kwargs)
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for offset in range(0, self.limit, 15):
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From GitHub: https://raw.githubusercontent.com/sunny9577/proxy-scraper/refs/heads/master/proxies.txt
@@ -329,320 +247,155 @@ class Gitrecon1455GitHubScraper(Scraper):
         super().__init__(method, "https://raw.githubusercontent.com/gitrecon1455/ProxyScraper/refs/heads/main/proxies.txt")
 
 # From proxy-spider.com
-class ProxySpiderScraper(Scraper):
+class ProxySpiderScraper(TableScraper):
 
     def __init__(self, method, location):
         self.location = location
         super().__init__(method, f"https://proxy-spider.com/proxies/locations/{location}")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From advanced.name
-class AdvancedNameScraper(Scraper):
+class AdvancedNameScraper(TableScraper):
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://advanced.name/freeproxy?page={page}")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 6):
             self._url = f"https://advanced.name/freeproxy?page={page}"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From premiumproxy.net
-class PremiumProxyScraper(Scraper):
+class PremiumProxyScraper(TableScraper):
 
     def __init__(self, method):
         super().__init__(method, "https://premiumproxy.net/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From free-proxy-list.net/web-proxy.html
-class FreeProxyListWebProxyScraper(Scraper):
+class FreeProxyListWebProxyScraper(TableScraper):
 
     def __init__(self, method):
         super().__init__(method, "https://free-proxy-list.net/web-proxy.html")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From www.socks-proxy.net
-class SocksProxyNetScraper(Scraper):
+class SocksProxyNetScraper(TableScraper):
 
     def __init__(self, method):
         super().__init__(method, "https://www.socks-proxy.net/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From www.sslproxies.org
-class SSLProxiesScraper(Scraper):
+class SSLProxiesScraper(TableScraper):
 
     def __init__(self, method):
         super().__init__(method, "https://www.sslproxies.org/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From premproxy.com
-class PremProxyScraper(Scraper):
+class PremProxyScraper(TableScraper):
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://premproxy.com/list/type-0{page}.htm")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 8):
             self._url = f"https://premproxy.com/list/type-0{page}.htm"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From plainproxies.com
-class PlainProxiesScraper(Scraper):
+class PlainProxiesScraper(TableScraper):
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://plainproxies.com/resources/free-proxy-list?page={page}")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 6):
             self._url = f"https://plainproxies.com/resources/free-proxy-list?page={page}"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From proxy-list.org
-class ProxyListOrgScraper(Scraper):
+class ProxyListOrgScraper(TableScraper):
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://proxy-list.org/english/index.php?p={page}")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 11):
             self._url = f"https://proxy-list.org/english/index.php?p={page}"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From hasdata.com
-class HasDataScraper(Scraper):
+class HasDataScraper(TableScraper):
 
     def __init__(self, method):
         super().__init__(method, "https://hasdata.com/free-proxy-list")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From proxybros.com
-class ProxyBrosScraper(Scraper):
+class ProxyBrosScraper(TableScraper):
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://proxybros.com/free-proxy-list/speed-1500/{page}/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                proxy = cells[0].text.strip()
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 31):
             self._url = f"https://proxybros.com/free-proxy-list/speed-1500/{page}/"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From www.freeproxy.world
-class FreeProxyWorldScraper(Scraper):
+class FreeProxyWorldScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://www.freeproxy.world/?type=&anonymity=&country=&speed=&port=&page={page}")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 140):  # تعديل هنا لجمع من 1 إلى 139
             self._url = f"https://www.freeproxy.world/?type=&anonymity=&country=&speed=&port=&page={page}"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From iproyal.com
-class IPRoyalScraper(Scraper):
+class IPRoyalScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://iproyal.com/free-proxy-list/?page={page}&entries=100")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 61):  # تعديل هنا لجمع من 1 إلى 60
             self._url = f"https://iproyal.com/free-proxy-list/?page={page}&entries=100"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From hidemy.name
-class HideMyNameScraper(Scraper):
+class HideMyNameScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method, page=1):
         self.page = page
         super().__init__(method, f"https://hidemy.name/en/proxy-list/?type={method}&start={page*64}")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
-    async def scrape(self, client):
+    async def scrape(self, sources):
         proxies = []
         for page in range(1, 6):
             self._url = f"https://hidemy.name/en/proxy-list/?type={self.method}&start={page*64}"
-            response = await self.get_response(client)
-            proxies.extend(await self.handle(response))
+            proxies.extend(await self.scrape_page(sources))
         return proxies
 
 # From proxylist.geonode.com
@@ -664,81 +417,33 @@ class GeoNodeProxyListScraper(Scraper):
         return super().get_url(limit=self.limit, page=self.page, sort_by=self.sort_by, sort_type=self.sort_type, **kwargs)
 
 # From free-proxy-list.net
-class FreeProxyListNetScraper(Scraper):
+class FreeProxyListNetScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method):
         super().__init__(method, "https://free-proxy-list.net/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From us-proxy.org
-class USProxyOrgScraper(Scraper):
+class USProxyOrgScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method):
         super().__init__(method, "https://us-proxy.org/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From socks-proxy.net
-class SocksProxyNetScraper(Scraper):
+class SocksProxyNetScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method):
         super().__init__(method, "https://www.socks-proxy.net/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 # From sslproxies.org
-class SSLProxiesOrgScraper(Scraper):
+class SSLProxiesOrgScraper(TableScraper):
+    columns = (0, 1)
 
     def __init__(self, method):
         super().__init__(method, "https://www.sslproxies.org/")
 
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table")
-        for row in table.findAll("tr"):
-            cells = row.findAll("td")
-            if len(cells) > 0:
-                ip = cells[0].text.strip()
-                port = cells[1].text.strip()
-                proxy = f"{ip}:{port}"
-                proxies.add(proxy)
-        return "\n".join(proxies)
-
 scrapers = [
     SpysMeScraper("http"),
     SpysMeScraper("socks"),
@@ -865,7 +570,7 @@ def verbose_print(verbose, message):
     if verbose:
         print(message)
 
-async def scrape(method, output, verbose):
+async def scrape(method, output, verbose, cache_dir=None, cache_size=50000000, parse_workers=0):
     now = time.time()
     methods = [method]
     if method == "all":
@@ -880,11 +585,13 @@ async def scrape(method, output, verbose):
 
     tasks = []
     client = httpx.AsyncClient(follow_redirects=True)
+    executor = ProcessPoolExecutor(parse_workers) if parse_workers else None
+    sources = Sources(client, ResponseCache(cache_dir, cache_size) if cache_dir else None, executor)
 
     async def scrape_scraper(scraper):
         try:
             verbose_print(verbose, f"Looking {scraper.get_url()}...")
-            proxies.extend(await scraper.scrape(client))
+            proxies.extend(await scraper.scrape(sources))
         except Exception:
             pass
 
@@ -893,6 +600,10 @@ async def scrape(method, output, verbose):
 
     await asyncio.gather(*tasks)
     await client.aclose()
+    if executor is not None:
+        executor.shutdown()
+    if sources.cache is not None:
+        sources.cache.save()
 
     proxies = set(proxies)
     verbose_print(verbose, f"Writing {len(proxies)} proxies to file...")
@@ -921,17 +632,35 @@ def main():
         help="Increase output verbosity",
         action="store_true",
     )
+    parser.add_argument(
+        "--cache",
+        help="Directory keeping source responses between runs; unchanged sources are revalidated instead of downloaded",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        help="Size cap of the cache directory in MB, least recently used sources are evicted first",
+        default=50,
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        help="Processes parsing downloaded pages while others download, 0 parses in the main process",
+        default=os.cpu_count() or 1,
+    )
     args = parser.parse_args()
+    run = scrape(args.proxy, args.output, args.verbose, args.cache, int(args.cache_size * 1000000),
+                 args.parse_workers)
 
     if sys.version_info >= (3, 7) and platform.system() == 'Windows':
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(scrape(args.proxy, args.output, args.verbose))
+        loop.run_until_complete(run)
         loop.close()
     elif sys.version_info >= (3, 7):
-        asyncio.run(scrape(args.proxy, args.output, args.verbose))
+        asyncio.run(run)
     else:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(scrape(args.proxy, args.output, args.verbose))
+        loop.run_until_complete(run)
         loop.close()
 
 if __name__ == "__main__":
@@ -1,12 +1,33 @@
 import argparse
+import asyncio
+import bisect
+import collections
+import csv
+import errno
+import http.server
+import ipaddress
+import json
+import multiprocessing
+import os
 import random
 import re
+import signal
 import socket
+import sqlite3
+import ssl
+import struct
+import sys
 import threading
-import urllib.request
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from time import time
+from urllib.parse import urlsplit
 
-import socks
+try:
+    import resource
+except ImportError:
+    # Windows has no file descriptor limit to size from
+    resource = None
 
 user_agents = [
     "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/37.0.2062.94 Chrome/37.0.2062.94 Safari/537.36"
@@ -25,93 +46,1572 @@ try:
 except FileNotFoundError:
     pass
 
+methods = ["http", "https", "socks4", "socks5", "auto"]
+
+proxy_pattern = re.compile(r"(?:([a-z0-9]+)://)?(\d{1,3}(?:\.\d{1,3}){3})(?::(\d{1,5}))?$")
+ipv4_pattern = re.compile(r"\d{1,3}(?:\.\d{1,3}){3}")
+
+# Successful checks needed before an adaptive timeout starts to tighten
+adaptive_warmup = 20
+
+# Proxies that may wait on full /24 or host limits, per unit of concurrency. Lists are often sorted,
+# so the reader has to look this far ahead to find work from other groups
+parked_per_worker = 32
+
+# Errors raised by our own host running out of sockets or ports rather than by the proxy
+local_errors = {errno.EMFILE, errno.ENFILE, errno.EADDRNOTAVAIL, errno.ENOBUFS, errno.ENOMEM}
+# Attempts at a check that keeps failing with a local error before it counts as failed
+local_error_retries = 3
+# File descriptors kept free for the list, output, journal and database
+reserved_files = 64
+# Concurrency the automatic sizing starts from before it grows or shrinks
+initial_concurrency = 500
+
+default_ports = {"http": 80, "https": 443, "socks4": 1080, "socks5": 1080}
+
+# One context for every TLS connection made through a proxy, instead of one per check
+ssl_context = ssl.create_default_context()
+
+# Judge answers are a few hundred bytes; anything past this is not a judge
+max_body_size = 65536
+
+# Request headers a proxy adds to say it forwarded the request, as echoed by a judge
+proxy_headers = {"via", "forwarded", "x-forwarded-for", "x-real-ip", "x-proxy-id", "proxy-connection",
+                 "client-ip", "x-client-ip", "forwarded-for", "x-originating-ip", "x-remote-addr"}
+
+# Anonymity levels from least to most private
+anonymity_levels = ["transparent", "anonymous", "elite"]
+
+socks4_errors = {
+    0x5B: "request rejected or failed",
+    0x5C: "request rejected because the SOCKS server cannot connect to identd on the client",
+    0x5D: "request rejected because the client program and identd report different user-ids",
+}
+
+socks5_errors = {
+    0x01: "general SOCKS server failure",
+    0x02: "connection not allowed by ruleset",
+    0x03: "network unreachable",
+    0x04: "host unreachable",
+    0x05: "connection refused",
+    0x06: "TTL expired",
+    0x07: "command not supported",
+    0x08: "address type not supported",
+}
+
+
+class ProxyError(Exception):
+    pass
+
+
+class SocksError(ProxyError):
+    pass
+
+
+async def recv_exactly(sock, size):
+    loop = asyncio.get_event_loop()
+    data = b""
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise SocksError("Connection closed by the SOCKS server")
+        data += chunk
+    return data
+
+
+def ip_literal(host):
+    try:
+        return ipaddress.ip_address(host)
+    except ValueError:
+        return None
+
+
+async def socks4_handshake(sock, host, port):
+    # Plain SOCKS4 for IPv4 literals, SOCKS4a (remote resolution) for hostnames
+    loop = asyncio.get_event_loop()
+    address = ip_literal(host)
+    if address is not None and address.version == 4:
+        request = struct.pack(">BBH", 4, 1, port) + address.packed + b"\x00"
+    elif address is None:
+        request = struct.pack(">BBH", 4, 1, port) + b"\x00\x00\x00\x01\x00" + host.encode("idna") + b"\x00"
+    else:
+        raise SocksError("SOCKS4 does not support IPv6 destinations")
+    await loop.sock_sendall(sock, request)
+    reply = await recv_exactly(sock, 8)
+    if reply[0] != 0:
+        raise SocksError("Invalid SOCKS4 reply")
+    if reply[1] != 0x5A:
+        raise SocksError(socks4_errors.get(reply[1], f"unknown SOCKS4 error {reply[1]:#x}"))
+
+
+async def socks5_handshake(sock, host, port):
+    loop = asyncio.get_event_loop()
+    await loop.sock_sendall(sock, b"\x05\x01\x00")
+    version, auth_method = await recv_exactly(sock, 2)
+    if version != 5:
+        raise SocksError("Invalid SOCKS5 reply")
+    if auth_method != 0:
+        raise SocksError("SOCKS5 server requires authentication")
+
+    address = ip_literal(host)
+    if address is None:
+        encoded_host = host.encode("idna")
+        destination = b"\x03" + bytes([len(encoded_host)]) + encoded_host
+    else:
+        destination = (b"\x01" if address.version == 4 else b"\x04") + address.packed
+    await loop.sock_sendall(sock, b"\x05\x01\x00" + destination + struct.pack(">H", port))
+
+    version, status, _, address_type = await recv_exactly(sock, 4)
+    if version != 5:
+        raise SocksError("Invalid SOCKS5 reply")
+    if status != 0:
+        raise SocksError(socks5_errors.get(status, f"unknown SOCKS5 error {status:#x}"))
+    # Drain the bound address so the tunnel starts on a clean byte boundary
+    if address_type == 1:
+        await recv_exactly(sock, 4 + 2)
+    elif address_type == 3:
+        length = (await recv_exactly(sock, 1))[0]
+        await recv_exactly(sock, length + 2)
+    elif address_type == 4:
+        await recv_exactly(sock, 16 + 2)
+    else:
+        raise SocksError("Invalid SOCKS5 reply")
+
+
+async def socks_handshake(version, sock, host, port):
+    if version == "socks4":
+        await socks4_handshake(sock, host, port)
+    else:
+        await socks5_handshake(sock, host, port)
+
+
+async def open_socks_connection(version, proxy_host, proxy_port, host, port):
+    # Each call owns its socket, so concurrent checks never share proxy state
+    sock = await open_connection(proxy_host, proxy_port)
+    try:
+        await socks_handshake(version, sock, host, port)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_connection(host, port):
+    loop = asyncio.get_event_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, (host, port))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def parse_status_line(line):
+    parts = line.decode("latin-1").split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise ProxyError(f"Invalid HTTP status line: {line[:64]!r}")
+    return int(parts[1]), parts[2].strip() if len(parts) > 2 else ""
+
+
+async def send_connect(sock, host, port):
+    # HTTP CONNECT handshake; the proxy stays silent after the head until the client speaks
+    loop = asyncio.get_event_loop()
+    await loop.sock_sendall(sock, (f"CONNECT {host}:{port} HTTP/1.1\r\n"
+                                   f"Host: {host}:{port}\r\n"
+                                   "\r\n").encode())
+    head = b""
+    while b"\r\n\r\n" not in head:
+        chunk = await loop.sock_recv(sock, 4096)
+        if not chunk:
+            raise ProxyError("Connection closed by the proxy")
+        head += chunk
+        if len(head) > 65536:
+            raise ProxyError("CONNECT response head too long")
+    return parse_status_line(head.split(b"\r\n", 1)[0])
+
+
+async def recv_status_line(sock):
+    # Reads just far enough for the status line; the rest of the answer is never looked at
+    loop = asyncio.get_event_loop()
+    data = b""
+    while b"\n" not in data:
+        chunk = await loop.sock_recv(sock, 1024)
+        if not chunk:
+            raise ProxyError("Connection closed by the proxy")
+        data += chunk
+        if len(data) > 8192:
+            raise ProxyError("HTTP status line too long")
+    return parse_status_line(data.split(b"\n", 1)[0])
+
+
+async def connect_tunnel(sock, host, port):
+    status, reason = await send_connect(sock, host, port)
+    if status != 200:
+        raise ProxyError(f"Tunnel connection failed: {status} {reason}")
+
+
+def build_request(url, user_agent, absolute=False):
+    if absolute:
+        target = url.geturl()
+    else:
+        target = (url.path or "/") + ("?" + url.query if url.query else "")
+    return (f"GET {target} HTTP/1.1\r\n"
+            f"Host: {url.netloc}\r\n"
+            f"User-Agent: {user_agent}\r\n"
+            "Accept: */*\r\n"
+            "Connection: close\r\n"
+            "\r\n").encode()
+
+
+async def read_status(reader):
+    return parse_status_line(await reader.readline())
+
+
+async def fetch(sock, url, user_agent, absolute=False, read_body=False):
+    # Send one GET over an already connected socket and read the response head,
+    # and the body too when a judge echoes the request back
+    try:
+        if url.scheme == "https":
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=url.hostname)
+        else:
+            reader, writer = await asyncio.open_connection(sock=sock)
+    except BaseException:
+        sock.close()
+        raise
+    try:
+        writer.write(build_request(url, user_agent, absolute))
+        status, reason = await read_status(reader)
+        first_byte_at = time()
+        length = None
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length" and value.strip().isdigit():
+                length = int(value)
+        body = None
+        if read_body and status < 400:
+            body = await reader.read(max_body_size) if length is None else await reader.readexactly(
+                min(length, max_body_size))
+    finally:
+        writer.close()
+    # Redirects are not followed: any answer below 400 proves the proxy relays traffic
+    if status >= 400:
+        raise ProxyError(f"HTTP Error {status}: {reason}")
+    return status, first_byte_at, body
+
+
+async def download(sock, url, user_agent, absolute, max_bytes, deadline):
+    # Reads the body of one GET until `max_bytes`, the end of the body or the deadline; returns
+    # when the first byte of the answer came, how many body bytes arrived and when it stopped
+    async def read_head():
+        if url.scheme == "https":
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=url.hostname)
+        else:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        try:
+            writer.write(build_request(url, user_agent, absolute))
+            status, reason = await read_status(reader)
+            first_byte_at = time()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+        except BaseException:
+            writer.close()
+            raise
+        if status >= 400:
+            writer.close()
+            raise ProxyError(f"HTTP Error {status}: {reason}")
+        return reader, writer, first_byte_at
+
+    try:
+        reader, writer, first_byte_at = await asyncio.wait_for(read_head(), max(deadline - time(), 0))
+    except BaseException:
+        sock.close()
+        raise
+    received = 0
+    try:
+        while received < max_bytes and time() < deadline:
+            try:
+                chunk = await asyncio.wait_for(reader.read(min(65536, max_bytes - received)), deadline - time())
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+    finally:
+        writer.close()
+    return first_byte_at, received, time()
+
+
+async def probe_socks5(proxy_host, proxy_port):
+    # SOCKS5 greeting only: a "no authentication" answer means the endpoint is usable as SOCKS5
+    loop = asyncio.get_event_loop()
+    sock = await open_connection(proxy_host, proxy_port)
+    try:
+        await loop.sock_sendall(sock, b"\x05\x01\x00")
+        return ["socks5"] if await recv_exactly(sock, 2) == b"\x05\x00" else []
+    finally:
+        sock.close()
+
+
+async def probe_socks4(proxy_host, proxy_port, host, port):
+    sock = await open_connection(proxy_host, proxy_port)
+    try:
+        await socks4_handshake(sock, host, port)
+        return ["socks4"]
+    finally:
+        sock.close()
+
+
+async def probe_http(proxy_host, proxy_port, host, port):
+    # Any HTTP answer to CONNECT means the endpoint speaks HTTP; a 200 means it can also tunnel
+    sock = await open_connection(proxy_host, proxy_port)
+    try:
+        status, _ = await send_connect(sock, host, port)
+        return ["http", "https"] if status == 200 else ["http"]
+    finally:
+        sock.close()
+
+
+def parse_echo(body):
+    # A judge answers with the address it saw and the request headers, one "Name: value" per line
+    headers = {}
+    for line in body.decode("latin-1").splitlines():
+        name, separator, value = line.partition(":")
+        if separator:
+            headers[name.strip().lower()] = value.strip()
+    return headers.pop("remote_addr", None), headers
+
+
+def classify_anonymity(body, own_address):
+    # Transparent proxies pass our address on, anonymous ones only admit being a proxy
+    _, headers = parse_echo(body)
+    addresses = {address for name, value in headers.items() if name != "host"
+                 for address in ipv4_pattern.findall(value)}
+    if own_address in addresses:
+        return "transparent"
+    if any(name in proxy_headers or name.startswith("x-forwarded-") for name in headers):
+        return "anonymous"
+    return "elite"
+
+
+async def judge_address(site, timeout):
+    # The address a judge sees for a request made without any proxy
+    url = site_url(site, "http")
+    sock = await asyncio.wait_for(open_connection(url.hostname, url.port or default_ports[url.scheme]), timeout)
+    _, _, body = await asyncio.wait_for(fetch(sock, url, user_agents[0], read_body=True), timeout)
+    remote_address, _ = parse_echo(body or b"")
+    if remote_address is None:
+        raise ProxyError(f"{site} does not answer like a judge")
+    return remote_address
+
+
+def site_url(site, default_scheme):
+    if "://" not in site:
+        site = default_scheme + "://" + site
+    return urlsplit(site)
+
 
 class Proxy:
+    # Slots keep each proxy small, since long lists create one object per line
+    __slots__ = ("method", "proxy", "latency", "connect_time", "first_byte_time", "anonymity", "speed",
+                 "speed_first_byte_time", "inconclusive")
+
     def __init__(self, method, proxy):
-        if method.lower() not in ["http", "https", "socks4", "socks5"]:
-            raise NotImplementedError("Only HTTP, HTTPS, SOCKS4, and SOCKS5 are supported")
+        if method.lower() not in methods:
+            raise NotImplementedError("Only HTTP, HTTPS, SOCKS4, SOCKS5, and auto detection are supported")
         self.method = method.lower()
         self.proxy = proxy
+        self.latency = None
+        self.connect_time = None
+        self.first_byte_time = None
+        self.anonymity = None
+        self.speed = None
+        self.speed_first_byte_time = None
+        # Failed for a reason that says nothing about the proxy: a cut-off shorter than --timeout
+        # or no sockets left on our side
+        self.inconclusive = False
 
     def is_valid(self):
-        return re.match(r"\d{1,3}(?:\.\d{1,3}){3}(?::\d{1,5})?$", self.proxy)
+        match = proxy_pattern.match(self.proxy)
+        # Auto detection has no protocol to take a default port from
+        return match is not None and match.group(1) is None and (self.method != "auto" or match.group(3) is not None)
 
-    def check(self, site, timeout, user_agent, verbose):
-        if self.method in ["socks4", "socks5"]:
-            socks.set_default_proxy(socks.SOCKS4 if self.method == "socks4" else socks.SOCKS5,
-                                    self.proxy.split(':')[0], int(self.proxy.split(':')[1]))
-            socket.socket = socks.socksocket
-            try:
-                start_time = time()
-                urllib.request.urlopen(site, timeout=timeout)
-                end_time = time()
-                time_taken = end_time - start_time
-                verbose_print(verbose, f"Proxy {self.proxy} is valid, time taken: {time_taken}")
-                return True, time_taken, None
-            except Exception as e:
-                verbose_print(verbose, f"Proxy {self.proxy} is not valid, error: {str(e)}")
-                return False, 0, e
-        else:
-            url = self.method + "://" + self.proxy
-            proxy_support = urllib.request.ProxyHandler({self.method: url})
-            opener = urllib.request.build_opener(proxy_support)
-            urllib.request.install_opener(opener)
-            req = urllib.request.Request(self.method + "://" + site)
-            req.add_header("User-Agent", user_agent)
-            try:
-                start_time = time()
-                urllib.request.urlopen(req, timeout=timeout)
-                end_time = time()
-                time_taken = end_time - start_time
-                verbose_print(verbose, f"Proxy {self.proxy} is valid, time taken: {time_taken}")
-                return True, time_taken, None
-            except Exception as e:
-                verbose_print(verbose, f"Proxy {self.proxy} is not valid, error: {str(e)}")
-                return False, 0, e
+    def key(self):
+        # Compact integer identity used to drop duplicate lines without keeping their strings
+        host, _, port = self.proxy.partition(":")
+        return ((methods.index(self.method) << 48) | (int.from_bytes(socket.inet_aton(host), "big") << 16)
+                | int(port or 0))
+
+    def group(self):
+        # Same protocol, /24 network and port: proxies of one provider's range
+        return self.key() & ~0xFF0000
+
+    def address(self):
+        host, _, port = self.proxy.partition(":")
+        return host, int(port) if port else default_ports[self.method]
+
+    async def open_site(self, url):
+        # Socket through the proxy, ready for an HTTP request to the site; plain HTTP proxies
+        # relay absolute-URI requests for plain HTTP sites instead of tunnelling
+        port = url.port or default_ports[url.scheme]
+        sock = await open_connection(*self.address())
+        try:
+            if self.method in ["socks4", "socks5"]:
+                await socks_handshake(self.method, sock, url.hostname, port)
+            elif url.scheme == "https" or self.method == "https":
+                await connect_tunnel(sock, url.hostname, port)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def request(self, site, user_agent, read_body=False):
+        # Returns the time to connect to the proxy, the time to the first byte of the answer and,
+        # when asked for, the body
+        start_time = time()
+        url = site_url(site, "https" if self.method == "https" else "http")
+        sock = await self.open_site(url)
+        connect_time = time() - start_time
+        _, first_byte_at, body = await fetch(sock, url, user_agent,
+                                             absolute=url.scheme == "http" and self.method == "http",
+                                             read_body=read_body)
+        return connect_time, first_byte_at - start_time, body
+
+    async def measure_speed(self, site, user_agent, max_bytes, timeout):
+        # Downloads up to `max_bytes` within `timeout` and sets the transfer rate after the first
+        # byte; a slow proxy is measured on what arrived in time rather than failed
+        start_time = time()
+        url = site_url(site, "https" if self.method == "https" else "http")
+        sock = await asyncio.wait_for(self.open_site(url), timeout)
+        first_byte_at, received, end_time = await download(sock, url, user_agent,
+                                                           url.scheme == "http" and self.method == "http",
+                                                           max_bytes, start_time + timeout)
+        self.speed_first_byte_time = first_byte_at - start_time
+        self.speed = received / max(end_time - first_byte_at, 1e-6)
+
+    async def request_raw(self, site, user_agent):
+        # Only proves the proxy relays: a granted SOCKS or CONNECT tunnel to an HTTPS site, or the
+        # status line of a plain GET, without TLS to the target or reading past the first line
+        loop = asyncio.get_event_loop()
+        start_time = time()
+        url = site_url(site, "https" if self.method == "https" else "http")
+        port = url.port or default_ports[url.scheme]
+        sock = await open_connection(*self.address())
+        connect_time = time() - start_time
+        try:
+            if self.method in ["socks4", "socks5"]:
+                await socks_handshake(self.method, sock, url.hostname, port)
+                if url.scheme == "https":
+                    return connect_time, time() - start_time, None
+                await loop.sock_sendall(sock, build_request(url, user_agent))
+            elif url.scheme == "https" or self.method == "https":
+                await loop.sock_sendall(sock, (f"CONNECT {url.hostname}:{port} HTTP/1.1\r\n"
+                                               f"Host: {url.hostname}:{port}\r\n"
+                                               "\r\n").encode())
+                status, reason = await recv_status_line(sock)
+                if status != 200:
+                    raise ProxyError(f"Tunnel connection failed: {status} {reason}")
+                return connect_time, time() - start_time, None
+            else:
+                await loop.sock_sendall(sock, build_request(url, user_agent, absolute=True))
+            status, reason = await recv_status_line(sock)
+            if status >= 400:
+                raise ProxyError(f"HTTP Error {status}: {reason}")
+            return connect_time, time() - start_time, None
+        finally:
+            sock.close()
+
+    async def check_async(self, site, timeout, user_agent, verbose, judge=False, own_address=None, probe="full"):
+        # With `judge`, the site echoes the request and the proxy is classified from it
+        try:
+            start_time = time()
+            request = self.request_raw(site, user_agent) if probe == "raw" else self.request(site, user_agent, judge)
+            self.connect_time, self.first_byte_time, body = await asyncio.wait_for(request, timeout)
+            end_time = time()
+            time_taken = end_time - start_time
+            self.latency = time_taken
+            if judge:
+                self.anonymity = classify_anonymity(body or b"", own_address)
+            verbose_print(verbose, f"Proxy {self.proxy} is valid, time taken: {time_taken}"
+                                   + (f", {self.anonymity}" if self.anonymity else ""))
+            return True, time_taken, None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = socket.timeout("timed out")
+            verbose_print(verbose, f"Proxy {self.proxy} is not valid, error: {str(e)}")
+            return False, 0, e
+
+    def check(self, site, timeout, user_agent, verbose, judge=False, own_address=None, probe="full"):
+        return asyncio.run(self.check_async(site, timeout, user_agent, verbose, judge, own_address, probe))
+
+    async def detect(self, site, timeout):
+        url = site_url(site, "http")
+        host, port = url.hostname, url.port or default_ports[url.scheme]
+        proxy_host, proxy_port = self.address()
+        probes = [
+            probe_socks5(proxy_host, proxy_port),
+            probe_socks4(proxy_host, proxy_port, host, port),
+            probe_http(proxy_host, proxy_port, host, port),
+        ]
+        results = await asyncio.gather(*[asyncio.wait_for(probe, timeout) for probe in probes],
+                                       return_exceptions=True)
+        for result in results:
+            # Our own shortage of sockets, not a protocol the proxy lacks
+            if is_local_error(result):
+                raise result
+        return [protocol for result in results if isinstance(result, list) for protocol in result]
 
     def __str__(self):
         return self.proxy
 
 
+class LivenessStore:
+    # Last check result per (proxy, protocol), so later runs only recheck stale entries
+
+    def __init__(self, path):
+        # Worker processes share the file, so wait for their write locks instead of failing
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS checks ("
+            "proxy TEXT NOT NULL, "
+            "protocol TEXT NOT NULL, "
+            "checked_at REAL NOT NULL, "
+            "alive INTEGER NOT NULL, "
+            "latency REAL, "
+            "error TEXT, "
+            "anonymity TEXT, "
+            "speed REAL, "
+            "PRIMARY KEY (proxy, protocol))"
+        )
+        # Databases from before anonymity and speed checks lack their columns
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(checks)")]
+        for column, column_type in [("anonymity", "TEXT"), ("speed", "REAL")]:
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE checks ADD COLUMN {column} {column_type}")
+        self.pending = []
+
+    def recent(self, max_age):
+        results = {}
+        rows = self.connection.execute(
+            "SELECT proxy, protocol, alive, latency, anonymity, speed FROM checks WHERE checked_at >= ?",
+            (time() - max_age,))
+        for proxy, protocol, alive, latency, anonymity, speed in rows:
+            results.setdefault(proxy, {})[protocol] = (bool(alive), latency, anonymity, speed)
+        return results
+
+    def record(self, proxy, protocol, alive, latency=None, error=None, anonymity=None, speed=None):
+        error_class = type(error).__name__ if error is not None else None
+        self.pending.append((proxy, protocol, time(), int(alive), latency if alive else None, error_class,
+                             anonymity, speed))
+        if len(self.pending) >= 500:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO checks (proxy, protocol, checked_at, alive, latency, error, anonymity, speed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.connection.commit()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class Journal:
+    # Append-only record of every finished proxy, so an interrupted run can resume
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = {}
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a crashed run may be cut short
+                        continue
+                    self.done[(entry["method"], entry["proxy"])] = entry["passed"]
+        # Line buffering puts every entry on disk in a single append
+        self.file = open(path, "a", buffering=1)
+
+    def finished(self, proxy, passed_proxies):
+        passed = [[p.method, p.latency, p.connect_time, p.first_byte_time, p.anonymity, p.speed,
+                   p.speed_first_byte_time] for p in passed_proxies]
+        self.file.write(json.dumps({"method": proxy.method, "proxy": proxy.proxy, "passed": passed}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def write_atomic(path, write):
+    # The old file stays intact until the new one is complete on disk
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", newline="") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+# Upper bounds in seconds of the latency histogram behind the live metrics
+latency_buckets = [0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60]
+
+# Counters of this process, set by check() or by the worker process initializer
+metrics_values = None
+
+
+class Metrics:
+    # Run counters in a flat array, so worker processes can all write into one shared block
+    fields = ["processed", "started", "finished", "passed"]
+    size = len(fields) + len(latency_buckets) + 1
+
+    def __init__(self, values, offset=0):
+        self.values = values
+        self.offset = offset
+
+    def add(self, field, amount=1):
+        self.values[self.offset + self.fields.index(field)] += amount
+
+    def observe(self, latency):
+        self.add("passed")
+        self.values[self.offset + len(self.fields) + bisect.bisect_left(latency_buckets, latency)] += 1
+
+    @classmethod
+    def totals(cls, values):
+        # Sums the counters of every shard stored in `values`
+        totals = [0] * cls.size
+        for offset in range(0, len(values), cls.size):
+            for index in range(cls.size):
+                totals[index] += values[offset + index]
+        counts = dict(zip(cls.fields, totals))
+        counts["buckets"] = totals[len(cls.fields):]
+        return counts
+
+
+def set_metrics_values(values):
+    global metrics_values
+    metrics_values = values
+
+
+def bucket_percentile(buckets, percent):
+    # Upper bound of the histogram bucket holding the given percentile
+    total = sum(buckets)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(latency_buckets + [float("inf")], buckets):
+        seen += count
+        if seen >= total * percent / 100:
+            return bound
+    return float("inf")
+
+
+class Reporter:
+    # Rate-limited view of the run: a status line, a JSON stats file and a Prometheus endpoint
+
+    def __init__(self, values, total, interval=5, progress=False, stats_file=None, metrics_port=None):
+        self.values = values
+        self.total = total
+        self.interval = interval
+        self.progress = progress
+        self.stats_file = stats_file
+        self.metrics_port = metrics_port
+        self.start_time = time()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def snapshot(self):
+        counts = Metrics.totals(self.values)
+        elapsed = max(time() - self.start_time, 1e-9)
+        rate = counts["finished"] / elapsed
+        processed_rate = counts["processed"] / elapsed
+        remaining = max(self.total - counts["processed"], 0)
+        return {
+            "elapsed": elapsed,
+            "total": self.total,
+            "processed": int(counts["processed"]),
+            "started": int(counts["started"]),
+            "finished": int(counts["finished"]),
+            "passed": int(counts["passed"]),
+            "in_flight": int(counts["started"] - counts["finished"]),
+            "checks_per_second": rate,
+            "pass_rate": counts["passed"] / counts["finished"] if counts["finished"] else None,
+            "eta": remaining / processed_rate if processed_rate else None,
+            "latency_p50": bucket_percentile(counts["buckets"], 50),
+            "latency_p90": bucket_percentile(counts["buckets"], 90),
+            "latency_p99": bucket_percentile(counts["buckets"], 99),
+            "buckets": [int(count) for count in counts["buckets"]],
+        }
+
+    def status_line(self, stats):
+        pass_rate = f"{stats['pass_rate']:.1%}" if stats["pass_rate"] is not None else "-"
+        eta = f"{stats['eta']:.0f}s" if stats["eta"] is not None else "-"
+        latency = "/".join("-" if stats[key] is None else f"{stats[key]:g}s"
+                           for key in ["latency_p50", "latency_p90", "latency_p99"])
+        return (f"[{stats['elapsed']:.0f}s] {stats['processed']}/{stats['total']} proxies, "
+                f"{stats['checks_per_second']:.1f} checks/s, {stats['in_flight']} in flight, "
+                f"{pass_rate} passed, ETA {eta}, latency p50/p90/p99 <= {latency}")
+
+    def prometheus(self):
+        stats = self.snapshot()
+        lines = []
+        for name, kind, value in [
+            ("proxy_checker_proxies_total", "gauge", stats["total"]),
+            ("proxy_checker_proxies_processed_total", "counter", stats["processed"]),
+            ("proxy_checker_checks_started_total", "counter", stats["started"]),
+            ("proxy_checker_checks_finished_total", "counter", stats["finished"]),
+            ("proxy_checker_checks_passed_total", "counter", stats["passed"]),
+            ("proxy_checker_checks_in_flight", "gauge", stats["in_flight"]),
+        ]:
+            lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        lines.append("# TYPE proxy_checker_latency_seconds histogram")
+        cumulative = 0
+        for bound, count in zip(latency_buckets + ["+Inf"], stats["buckets"]):
+            cumulative += count
+            lines.append(f'proxy_checker_latency_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"proxy_checker_latency_seconds_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        stats = self.snapshot()
+        if self.progress:
+            print(self.status_line(stats), flush=True)
+        if self.stats_file is not None:
+            write_atomic(self.stats_file, lambda f: json.dump(stats, f))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self):
+        if self.metrics_port is not None:
+            reporter = self
+
+            class MetricsHandler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = reporter.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.metrics_port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.progress or self.stats_file is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.report()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def is_local_error(error):
+    return isinstance(error, OSError) and error.errno in local_errors
+
+
+def auto_concurrency(workers=1, sockets=1):
+    # Largest safe number of checks per process: `sockets` each within the file descriptor
+    # limit, and the worker processes together within the ephemeral port range
+    if resource is None:
+        return initial_concurrency
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    limit = (soft - reserved_files) // sockets if soft != resource.RLIM_INFINITY else 65536
+    try:
+        with open("/proc/sys/net/ipv4/ip_local_port_range") as f:
+            low, high = map(int, f.read().split())
+        limit = min(limit, (high - low + 1) // workers // sockets)
+    except (OSError, ValueError):
+        pass
+    return max(limit, 1)
+
+
+class ConcurrencyWindow:
+    # Checks in flight, halved when our own host runs out of sockets or ports and grown back by one
+    # for every ten checks that connect. An adaptive window also halves when connecting gets much
+    # slower than it was, and may grow up to the largest size the host allows
+
+    def __init__(self, limit, maximum, adaptive=False, verbose=False):
+        self.limit = limit
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.verbose = verbose
+        self.active = 0
+        # Workers waiting for room, woken one at a time so a release does not stir all of them
+        self.waiters = collections.deque()
+        self.connect_time = None
+        self.samples = 0
+        self.baseline = None
+        self.decreased_at = 0
+
+    async def acquire(self):
+        if self.active < int(self.limit) and not self.waiters:
+            self.active += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # wake() counts the worker as active before resolving its future
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def wake(self):
+        while self.waiters and self.active < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def decrease(self, reason):
+        # One decrease per second at most, so a burst of failures from one moment counts once
+        if time() - self.decreased_at < 1:
+            return
+        self.decreased_at = time()
+        self.limit = max(1, self.limit / 2)
+        # Judge the new window by checks it started, not by the ones still draining from the old one
+        self.connect_time = None
+        self.samples = 0
+        verbose_print(self.verbose, f"Concurrency lowered to {int(self.limit)}: {reason}")
+
+    def connected(self, connect_time):
+        # Smoothed connect time against the best smoothed value seen, as a sign of local congestion
+        self.connect_time = connect_time if self.connect_time is None else (0.9 * self.connect_time
+                                                                            + 0.1 * connect_time)
+        self.samples += 1
+        if self.samples < adaptive_warmup:
+            return
+        self.baseline = self.connect_time if self.baseline is None else min(self.baseline, self.connect_time)
+        if self.adaptive and self.connect_time > 2 * self.baseline + 0.05:
+            self.decrease(f"connect time rose to {self.connect_time:.3f}s")
+        elif self.active >= self.limit - 1 and self.limit < self.maximum:
+            # Only grow while the window is what holds checks back
+            self.limit = min(self.maximum, self.limit + 0.1)
+            self.wake()
+
+
+def parse_proxy(line, method):
+    # Fast path for "ip:port" lines; a "protocol://" prefix overrides auto detection
+    # and lines for another protocol are skipped
+    match = proxy_pattern.match(line.strip().lower())
+    if match is None:
+        return None
+    scheme, host, port = match.groups()
+    if scheme is not None:
+        if scheme not in default_ports or method not in [scheme, "auto"]:
+            return None
+        method = scheme
+    elif method == "auto" and port is None:
+        return None
+    octets = [int(octet) for octet in host.split(".")]
+    if max(octets) > 255 or (port is not None and not 0 < int(port) < 65536):
+        return None
+    proxy = ".".join(map(str, octets))
+    if port is not None:
+        proxy += ":" + str(int(port))
+    return Proxy(method, proxy)
+
+
+def read_proxies(file, method, shard=0, shards=1, metrics=None):
+    # Lazily yields valid, normalized and deduplicated proxies; a /24 range always lands in
+    # the same shard, so duplicates and sampled groups stay inside one worker process.
+    # Skipped lines still count as processed so progress reaches the line count
+    seen = set()
+    with open(file, "r") as f:
+        for line in f:
+            proxy = parse_proxy(line, method)
+            if proxy is None:
+                if metrics is not None and shard == 0:
+                    metrics.add("processed")
+                continue
+            if shards > 1 and zlib.crc32(proxy.group().to_bytes(8, "big")) % shards != shard:
+                continue
+            key = proxy.key()
+            if key in seen:
+                if metrics is not None:
+                    metrics.add("processed")
+                continue
+            seen.add(key)
+            yield proxy
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of an already sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))]
+
+
+def write_results(path, proxies):
+    fields = ["proxy", "protocol", "latency", "connect_time", "first_byte_time", "anonymity", "speed",
+              "speed_first_byte_time"]
+
+    def write(f):
+        rows = ([proxy.proxy, proxy.method, proxy.latency, proxy.connect_time, proxy.first_byte_time, proxy.anonymity,
+                 proxy.speed, proxy.speed_first_byte_time] for proxy in proxies)
+        if path.lower().endswith(".csv"):
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(fields, row))) + "\n")
+
+    write_atomic(path, write)
+
+
 def verbose_print(verbose, message):
     if verbose:
         print(message)
 
 
-def check(file, timeout, method, site, verbose, random_user_agent):
-    proxies = []
-    with open(file, "r") as f:
-        for line in f:
-            proxies.append(Proxy(method, line.replace("\n", "")))
+class Checker:
+    # Proxies stream from a bounded queue through the enabled stages one by one, so a
+    # run never holds more than the in-flight proxies and the ones that passed
 
-    print(f"Checking {len(proxies)} proxies")
-    proxies = filter(lambda x: x.is_valid(), proxies)
-    valid_proxies = []
+    def __init__(self, method, site, timeout, verbose, user_agent, random_user_agent, concurrency, prefilter=None,
+                 prefilter_timeout=3, detect_timeout=5, store=None, max_age=None, want=None, fastest=False,
+                 adaptive_timeout=False, timeout_margin=1, journal=None, metrics=None, anonymity=None,
+                 probe="full", sample=None, dead_groups="skip", subnet_limit=None, host_limit=None,
+                 adaptive_concurrency=False, speed_url=None, speed_bytes=1000000, speed_timeout=10, min_speed=None,
+                 own_address=None):
+        self.method = method
+        self.site = site
+        self.timeout = timeout
+        self.verbose = verbose
+        self.user_agent = user_agent
+        self.random_user_agent = random_user_agent
+        self.concurrency = concurrency
+        self.prefilter = prefilter
+        self.prefilter_timeout = prefilter_timeout
+        self.detect_timeout = detect_timeout
+        self.store = store
+        self.want = want
+        self.fastest = fastest
+        self.adaptive_timeout = adaptive_timeout
+        self.timeout_margin = timeout_margin
+        self.journal = journal
+        self.metrics = metrics if metrics is not None else Metrics([0] * Metrics.size)
+        self.anonymity = anonymity
+        self.own_address = own_address
+        self.probe = probe
+        self.sample = sample
+        self.dead_groups = dead_groups
+        self.live_groups = set()
+        self.subnet_limit = subnet_limit
+        self.host_limit = host_limit
+        self.parked = 0
+        self.speed_url = speed_url
+        self.speed_bytes = speed_bytes
+        self.speed_timeout = speed_timeout
+        self.min_speed = min_speed
+        # Every worker task exists from the start; the window decides how many of them may check
+        self.window = ConcurrencyWindow(min(initial_concurrency, concurrency) if adaptive_concurrency else concurrency,
+                                        concurrency, adaptive_concurrency, verbose)
+        self.recent = store.recent(max_age) if max_age is not None else None
+        self.valid_proxies = []
+        self.passed_keys = set()
+        self.latencies = []
+        self.counts = {}
+        if max_age is not None:
+            self.counts["stale"] = 0
+        if prefilter is not None:
+            self.counts["reachable"] = 0
+        if sample is not None:
+            self.counts["dead_groups"] = 0
+            self.counts["pruned"] = 0
+        self.tasks = []
+
+    def enough(self):
+        return self.want is not None and not self.fastest and len(self.valid_proxies) >= self.want
+
+    def passed(self, proxy):
+        # Auto detection can find a protocol that another line already named explicitly
+        key = proxy.key()
+        if key in self.passed_keys:
+            return
+        self.passed_keys.add(key)
+        self.valid_proxies.append(proxy)
+        if proxy.latency is not None:
+            bisect.insort(self.latencies, proxy.latency)
+        if self.enough():
+            # Enough proxies passed: stop scheduling and cancel the checks still in flight
+            for task in self.tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+    def reuse(self, proxy):
+        # Fresh results from the store stand in for a check; returns False if the proxy must be checked
+        results = self.recent.get(proxy.proxy, {})
+        if proxy.method != "auto":
+            results = {proxy.method: results[proxy.method]} if proxy.method in results else {}
+        elif "auto" not in results:
+            # Rows left by runs for one protocol say nothing about the others the proxy may speak
+            results = {}
+        # Rows from runs without a judge or speed test cannot answer the filters asked for now
+        lacking = any(alive and protocol != "auto"
+                      and ((self.anonymity is not None and anonymity is None)
+                           or (self.min_speed is not None and speed is None))
+                      for protocol, (alive, _, anonymity, speed) in results.items())
+        if not results or lacking:
+            self.counts["stale"] += 1
+            return False
+        for protocol, (alive, latency, anonymity, speed) in results.items():
+            if alive and protocol != "auto":
+                reused_proxy = Proxy(protocol, proxy.proxy)
+                reused_proxy.latency = latency
+                reused_proxy.anonymity = anonymity
+                reused_proxy.speed = speed
+                if self.anonymous_enough(reused_proxy) and self.fast_enough(reused_proxy):
+                    self.passed(reused_proxy)
+        return True
+
+    def resume(self, proxy):
+        # Proxies finished by an interrupted run keep their result; returns False if the proxy must be checked
+        passed = self.journal.done.get((proxy.method, proxy.proxy))
+        if passed is None:
+            return False
+        for protocol, latency, connect_time, first_byte_time, anonymity, speed, speed_first_byte_time in passed:
+            resumed_proxy = Proxy(protocol, proxy.proxy)
+            resumed_proxy.latency = latency
+            resumed_proxy.connect_time = connect_time
+            resumed_proxy.first_byte_time = first_byte_time
+            resumed_proxy.anonymity = anonymity
+            resumed_proxy.speed = speed
+            resumed_proxy.speed_first_byte_time = speed_first_byte_time
+            self.passed(resumed_proxy)
+        return True
+
+    async def connects(self, proxy):
+        # Cheap first stage: only proxies that accept a TCP connection go on to the full check
+        try:
+            sock = await asyncio.wait_for(open_connection(*proxy.address()), self.prefilter_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_local_error(e):
+                # Out of sockets or ports here, which says nothing about the proxy
+                self.window.decrease(e)
+                return True
+            if self.store is not None:
+                self.store.record(proxy.proxy, proxy.method, False, error=e)
+            return False
+        sock.close()
+        self.counts["reachable"] += 1
+        return True
+
+    async def back_off(self, error, attempt):
+        # Out of sockets or ports here: shrink the window and wait until it has room again before
+        # the same proxy is tried again
+        self.window.decrease(error)
+        self.window.release()
+        try:
+            await asyncio.sleep(attempt + 1)
+            await self.window.acquire()
+        except asyncio.CancelledError:
+            # The worker gives the slot back on its way out
+            self.window.active += 1
+            raise
+
+    async def detect(self, proxy):
+        # Each protocol the endpoint speaks becomes its own candidate for the full check; None
+        # when our side ran out of sockets every time, which says nothing about the proxy
+        for attempt in range(local_error_retries):
+            try:
+                protocols = await proxy.detect(self.site, self.detect_timeout)
+                break
+            except OSError as e:
+                if attempt == local_error_retries - 1:
+                    return None
+                await self.back_off(e, attempt)
+        if protocols:
+            verbose_print(self.verbose, f"Proxy {proxy} speaks {', '.join(protocols)}")
+        # Counted only once detection ran, lines naming their protocol skip it
+        self.counts["detected"] = self.counts.get("detected", 0) + len(protocols)
+        return [Proxy(protocol, proxy.proxy) for protocol in protocols]
+
+    def anonymous_enough(self, proxy):
+        # Results from runs without a judge have no level and only pass when none is asked for
+        if self.anonymity is None:
+            return True
+        return (proxy.anonymity is not None
+                and anonymity_levels.index(proxy.anonymity) >= anonymity_levels.index(self.anonymity))
+
+    def fast_enough(self, proxy):
+        if self.min_speed is None:
+            return True
+        return proxy.speed is not None and proxy.speed >= self.min_speed
+
+    async def measure(self, proxy):
+        # Throughput stage, only for proxies that passed: a failed download leaves the speed unset
+        user_agent = random.choice(user_agents) if self.random_user_agent else self.user_agent
+        try:
+            await proxy.measure_speed(self.speed_url, user_agent, self.speed_bytes, self.speed_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            verbose_print(self.verbose, f"Proxy {proxy} failed the speed test, error: {str(e)}")
+            return
+        verbose_print(self.verbose, f"Proxy {proxy} moves {proxy.speed / 1000:.1f} KB/s, first byte after "
+                                    f"{proxy.speed_first_byte_time:.3f}s")
+
+    def check_timeout(self):
+        timeout = self.timeout
+        if self.fastest and len(self.latencies) >= self.want:
+            # A proxy slower than the current N-th best can never make the cut
+            timeout = min(timeout, self.latencies[self.want - 1])
+        if self.adaptive_timeout and len(self.latencies) >= adaptive_warmup:
+            # Good proxies answer well inside p95 of what has passed so far
+            timeout = min(timeout, percentile(self.latencies, 95) + self.timeout_margin)
+        return timeout
+
+    async def check(self, proxy):
+        user_agent = self.user_agent
+        if self.random_user_agent:
+            user_agent = random.choice(user_agents)
+        for attempt in range(local_error_retries):
+            self.metrics.add("started")
+            timeout = self.check_timeout()
+            valid, time_taken, error = await proxy.check_async(self.site, timeout, user_agent,
+                                                               self.verbose, self.anonymity is not None,
+                                                               self.own_address, self.probe)
+            self.metrics.add("finished")
+            if not is_local_error(error) or attempt == local_error_retries - 1:
+                break
+            await self.back_off(error, attempt)
+        if valid:
+            self.metrics.observe(time_taken)
+            self.window.connected(proxy.connect_time)
+        if valid and self.speed_url is not None and self.anonymous_enough(proxy) and not self.enough():
+            await self.measure(proxy)
+        if self.enough():
+            # The check finished in the same step the worker was cancelled, so the cancel was lost
+            return None
+        proxy.inconclusive = not valid and ((timeout < self.timeout and isinstance(error, socket.timeout))
+                                            or is_local_error(error))
+        if self.store is not None and not proxy.inconclusive:
+            self.store.record(proxy.proxy, proxy.method, valid, time_taken, error, proxy.anonymity, proxy.speed)
+        if valid and not self.anonymous_enough(proxy):
+            verbose_print(self.verbose, f"Proxy {proxy} is {proxy.anonymity}, dropped")
+            valid = False
+        if valid and not self.fast_enough(proxy):
+            verbose_print(self.verbose, f"Proxy {proxy} is too slow, dropped")
+            valid = False
+        if valid:
+            self.passed(proxy)
+        return valid
+
+    async def process(self, proxy):
+        candidates = []
+        detected = False
+        if self.prefilter != "connect" or await self.connects(proxy):
+            candidates = [proxy]
+            if proxy.method == "auto":
+                candidates = await self.detect(proxy)
+                if candidates is None:
+                    # A later run with more sockets to spare still has to check it
+                    self.metrics.add("processed")
+                    return
+                detected = True
+        passed_proxies = []
+        settled = True
+        for candidate in candidates:
+            valid = await self.check(candidate) if not self.enough() else None
+            if valid is None:
+                # Cut short by --want, so an interrupted run would still have to check it
+                return
+            if valid:
+                passed_proxies.append(candidate)
+            settled = settled and not candidate.inconclusive
+        self.metrics.add("processed")
+        if passed_proxies and self.sample is not None:
+            self.live_groups.add(proxy.group())
+        if not settled:
+            # A later run with the full timeout still has to check it
+            return
+        if detected and self.store is not None:
+            # Marks the detection as done once every protocol found has its own row
+            self.store.record(proxy.proxy, "auto", bool(candidates),
+                              error=None if candidates else ProxyError("No supported protocol detected"))
+        if self.journal is not None:
+            self.journal.finished(proxy, passed_proxies)
+
+    def slots(self, proxy):
+        # The /24 and host in-flight limits that apply to a proxy
+        ip = (proxy.key() >> 16) & 0xFFFFFFFF
+        slots = []
+        if self.subnet_limit is not None:
+            slots.append((("subnet", ip >> 8), self.subnet_limit))
+        if self.host_limit is not None:
+            slots.append((("host", ip), self.host_limit))
+        return slots
+
+    def prune(self, proxy):
+        # A group whose samples all failed is taken as dead without checking the rest of it
+        self.counts["pruned"] += 1
+        self.metrics.add("processed")
+        if self.journal is not None:
+            self.journal.finished(proxy, [])
+
+    async def run(self, proxies, reread=None):
+        # A pool of workers, as large as the window, drains the queue, so at most `concurrency`
+        # proxies are in flight and the reader stays a few steps ahead of them.
+        # With sampling, `reread` returns a fresh pass over the list
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        if self.anonymity is not None and self.own_address is None:
+            self.own_address = await judge_address(self.site, self.timeout)
+
+        async def produce():
+            samples = {}
+            # Proxies already settled in the first pass, so later passes do not touch them again
+            settled = set()
+            for proxy in proxies:
+                if ((self.journal is not None and self.resume(proxy))
+                        or (self.recent is not None and self.reuse(proxy))):
+                    self.metrics.add("processed")
+                    if self.sample is not None:
+                        settled.add(proxy.key())
+                    if self.enough():
+                        # --want was reached here, which cancelled the workers, so nothing would
+                        # drain the queue any more
+                        return
+                    continue
+                if self.sample is not None:
+                    group = proxy.group()
+                    if samples.get(group, 0) >= self.sample:
+                        continue
+                    samples[group] = samples.get(group, 0) + 1
+                    settled.add(proxy.key())
+                await queue.put(proxy)
+            if self.sample is not None:
+                # Every sample must be settled before the rest of its group is judged
+                await queue.join()
+                dead_groups = set(samples) - self.live_groups
+                self.counts["dead_groups"] = len(dead_groups)
+                for proxy in reread():
+                    if proxy.key() in settled:
+                        continue
+                    if proxy.group() not in dead_groups:
+                        await queue.put(proxy)
+                    elif self.dead_groups == "skip":
+                        self.prune(proxy)
+                if self.dead_groups == "defer":
+                    # Ranges that looked dead are still checked, after everything else
+                    for proxy in reread():
+                        if proxy.key() not in settled and proxy.group() in dead_groups:
+                            await queue.put(proxy)
+            # One end marker that every worker passes on to the next before leaving
+            await queue.put(None)
+
+        # Proxies whose /24 or host is at its in-flight limit wait here, keyed by the full slot,
+        # while their worker moves on to other groups
+        in_flight = {}
+        parked = {}
+        ready = collections.deque()
+        released = [asyncio.Event()]
+
+        def blocked_slot(proxy):
+            for slot, limit in self.slots(proxy):
+                if in_flight.get(slot, 0) >= limit:
+                    return slot
+            return None
+
+        def park(proxy, slot):
+            parked.setdefault(slot, collections.deque()).append(proxy)
+            self.parked += 1
+
+        def wake(slot):
+            # Hands the next waiting proxy of a freed slot to the releasing worker; one that is
+            # still held up by its other slot moves to that slot's line instead
+            waiting = parked.get(slot)
+            while waiting:
+                blocker = blocked_slot(waiting[0])
+                if blocker == slot:
+                    break
+                proxy = waiting.popleft()
+                if blocker is None:
+                    self.parked -= 1
+                    ready.append(proxy)
+                    break
+                parked.setdefault(blocker, collections.deque()).append(proxy)
+            if not waiting:
+                parked.pop(slot, None)
+
+        async def worker():
+            while True:
+                if ready:
+                    proxy = ready.popleft()
+                elif self.parked >= int(self.window.limit) * parked_per_worker:
+                    # Enough proxies are waiting on busy groups: take no more until one frees up
+                    await released[0].wait()
+                    continue
+                else:
+                    proxy = await queue.get()
+                    if proxy is None:
+                        queue.put_nowait(None)
+                        return
+                if self.enough():
+                    return
+                slot = blocked_slot(proxy)
+                if slot is not None:
+                    park(proxy, slot)
+                    continue
+                slots = self.slots(proxy)
+                for slot, _ in slots:
+                    in_flight[slot] = in_flight.get(slot, 0) + 1
+                try:
+                    await self.window.acquire()
+                    try:
+                        await self.process(proxy)
+                    finally:
+                        self.window.release()
+                finally:
+                    for slot, _ in slots:
+                        in_flight[slot] -= 1
+                        if not in_flight[slot]:
+                            del in_flight[slot]
+                        wake(slot)
+                    released[0].set()
+                    released[0] = asyncio.Event()
+                    queue.task_done()
+                    spawn()
+
+        def spawn():
+            # Workers are started as the window grows into them, so an adaptive run does not
+            # create the largest pool the host allows before it is ever needed
+            if self.enough():
+                return
+            while len(self.tasks) - 1 < min(self.concurrency, int(self.window.limit)):
+                self.tasks.append(asyncio.ensure_future(worker()))
+
+        self.tasks = [asyncio.ensure_future(produce())]
+        spawn()
+        gathered = 0
+        while gathered < len(self.tasks):
+            # Workers started while waiting are gathered on the next round
+            tasks = self.tasks[gathered:]
+            gathered = len(self.tasks)
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                    raise result
+        if self.fastest:
+            self.valid_proxies.sort(key=lambda x: (x.latency is None, x.latency))
+        return self.valid_proxies[:self.want]
+
+
+def check_shard(file, method, site, timeout, verbose, user_agent, random_user_agent, concurrency, prefilter,
+                prefilter_timeout, detect_timeout, db, max_age, want, fastest, adaptive_timeout, timeout_margin,
+                journal_path, resume, anonymity=None, probe="full", sample=None, dead_groups="skip",
+                subnet_limit=None, host_limit=None, adaptive_concurrency=False, speed_url=None, speed_bytes=1000000,
+                speed_timeout=10, min_speed=None, own_address=None, shard=0, shards=1):
+    # Runs every stage for one share of the list, so worker processes can split
+    # a list without the parent shipping it to them
+    store = LivenessStore(db) if db is not None else None
+    journal = Journal(journal_path, resume)
+    try:
+        checker = Checker(method, site, timeout, verbose, user_agent, random_user_agent, concurrency, prefilter,
+                          prefilter_timeout, detect_timeout, store, max_age, want, fastest, adaptive_timeout,
+                          timeout_margin, journal, Metrics(metrics_values, shard * Metrics.size), anonymity,
+                          probe, sample, dead_groups, subnet_limit, host_limit, adaptive_concurrency, speed_url,
+                          speed_bytes, speed_timeout, min_speed, own_address)
+        valid_proxies = asyncio.run(checker.run(read_proxies(file, method, shard, shards, checker.metrics),
+                                                lambda: read_proxies(file, method, shard, shards)))
+    finally:
+        journal.close()
+        if store is not None:
+            store.close()
+    return valid_proxies, checker.counts
+
+
+def check(file, timeout, method, site, verbose, random_user_agent, concurrency="auto", prefilter=None,
+          prefilter_timeout=3, detect_timeout=5, db=None, max_age=None, sort=None, results=None,
+          want=None, fastest=False, workers=1, adaptive_timeout=False, timeout_margin=1, output=None, resume=False,
+          progress=False, stats_file=None, metrics_port=None, stats_interval=5, anonymity=None, probe="full",
+          sample=None, dead_groups="skip", subnet_limit=None, host_limit=None, speed_url=None, speed_bytes=1000000,
+          speed_timeout=10, min_speed=None):
+    if workers < 1:
+        raise ValueError("Workers must be at least 1")
+    adaptive_concurrency = concurrency == "auto"
+    if adaptive_concurrency:
+        # Detection probes every protocol at once, three sockets for one check
+        concurrency = auto_concurrency(workers, 3 if method == "auto" else 1)
+    elif concurrency < 1:
+        raise ValueError("Concurrency must be at least 1")
+    if max_age is not None and db is None:
+        raise ValueError("--max-age needs a liveness database (--db)")
+    if fastest and want is None:
+        raise ValueError("--fastest needs the number of wanted proxies (--want)")
+    if anonymity is not None and anonymity not in anonymity_levels:
+        raise ValueError("Anonymity must be one of: " + ", ".join(anonymity_levels))
+    if probe not in ["full", "raw"]:
+        raise ValueError("Probe must be full or raw")
+    if sample is not None and sample < 1:
+        raise ValueError("Sample must be at least 1")
+    if (subnet_limit is not None and subnet_limit < 1) or (host_limit is not None and host_limit < 1):
+        raise ValueError("In-flight limits must be at least 1")
+    if min_speed is not None and speed_url is None:
+        raise ValueError("--min-speed needs a speed test download (--speed-url)")
+    if dead_groups not in ["skip", "defer"]:
+        raise ValueError("Dead groups must be skipped or deferred")
+    if anonymity is not None and probe == "raw":
+        raise ValueError("--anonymity needs the judge's answer, which --probe raw does not read")
+    own_address = None
+    if anonymity is not None:
+        # Asked once here, so every worker compares against the same address and a bad judge
+        # fails the run before it starts
+        try:
+            own_address = asyncio.run(judge_address(site, timeout))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ProxyError) as e:
+            raise ValueError(f"--anonymity needs a judge, but {site} could not be used: {e or 'timed out'}")
+    output = output or file
+    journal_path = output + ".journal"
+    if resume and os.path.exists(journal_path):
+        print(f"Resuming from {journal_path}")
+    else:
+        open(journal_path, "w").close()
+    with open(file, "r") as f:
+        total = sum(1 for _ in f)
+    print(f"Checking {total} proxies")
+    if adaptive_concurrency:
+        verbose_print(verbose, f"Concurrency starts at {min(initial_concurrency, concurrency)} and may grow to "
+                               f"{concurrency} per worker")
     user_agent = random.choice(user_agents)
+    options = dict(file=file, method=method, site=site, timeout=timeout, verbose=verbose, user_agent=user_agent,
+                   random_user_agent=random_user_agent, concurrency=concurrency, prefilter=prefilter,
+                   prefilter_timeout=prefilter_timeout, detect_timeout=detect_timeout, db=db, max_age=max_age,
+                   want=want, fastest=fastest, adaptive_timeout=adaptive_timeout, timeout_margin=timeout_margin,
+                   journal_path=journal_path, resume=resume, anonymity=anonymity, probe=probe,
+                   sample=sample, dead_groups=dead_groups, subnet_limit=subnet_limit, host_limit=host_limit,
+                   adaptive_concurrency=adaptive_concurrency, speed_url=speed_url, speed_bytes=speed_bytes,
+                   speed_timeout=speed_timeout, min_speed=min_speed, own_address=own_address)
+
+    if workers == 1:
+        set_metrics_values([0] * Metrics.size)
+    else:
+        set_metrics_values(multiprocessing.Array("d", Metrics.size * workers, lock=False))
+    reporter = Reporter(metrics_values, total, stats_interval, progress, stats_file, metrics_port)
+    reporter.start()
+
+    try:
+        if workers == 1:
+            shard_results = [check_shard(**options)]
+        else:
+            # Every worker process runs its own event loop over its share of the list
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=set_metrics_values,
+                                           initargs=(metrics_values,))
+            futures = []
+            try:
+                futures = [executor.submit(check_shard, shard=shard, shards=workers, **options)
+                           for shard in range(workers)]
+                shard_results = [future.result() for future in futures]
+            except KeyboardInterrupt:
+                # Ctrl+C reaches the workers too, but a SIGINT sent to this process alone would leave
+                # them checking their whole share, so pass it on to those still running
+                deadline = time() + 1
+                for process in multiprocessing.active_children():
+                    process.join(max(deadline - time(), 0))
+                    if process.is_alive():
+                        os.kill(process.pid, signal.SIGINT)
+                # By hand, shutdown() only cancels them itself from Python 3.9 on
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+                raise
+            executor.shutdown()
+    except KeyboardInterrupt:
+        print(f"Interrupted, finished proxies are kept in {journal_path}; run again with --resume to continue")
+        raise
+    finally:
+        reporter.stop()
 
-    def check_proxy(proxy, user_agent):
-        new_user_agent = user_agent
-        if random_user_agent:
-            new_user_agent = random.choice(user_agents)
-        valid, time_taken, error = proxy.check(site, timeout, new_user_agent, verbose)
-        valid_proxies.extend([proxy] if valid else [])
+    valid_proxies = []
+    counts = {}
+    for shard_proxies, shard_counts in shard_results:
+        valid_proxies.extend(shard_proxies)
+        for key, value in shard_counts.items():
+            counts[key] = counts.get(key, 0) + value
 
-    threads = []
-    for proxy in proxies:
-        t = threading.Thread(target=check_proxy, args=(proxy, user_agent))
-        threads.append(t)
+    if "stale" in counts:
+        print(f"{counts['stale']} proxies were new or not checked in the last {max_age} seconds")
+    if "reachable" in counts:
+        print(f"{counts['reachable']} proxies accepted a connection")
+    if "detected" in counts:
+        print(f"Detected {counts['detected']} proxy protocols to check")
+    if "pruned" in counts:
+        print(f"{counts['dead_groups']} subnets failed every sample, {counts['pruned']} of their proxies were skipped")
 
-    for t in threads:
-        t.start()
+    if fastest:
+        valid_proxies = sorted(valid_proxies, key=lambda x: (x.latency is None, x.latency))[:want]
+    elif want is not None:
+        valid_proxies = valid_proxies[:want]
 
-    for t in threads:
-        t.join()
+    if sort == "latency":
+        valid_proxies.sort(key=lambda x: (x.latency is None, x.latency))
 
-    with open(file, "w") as f:
+    def write_output(f):
         for proxy in valid_proxies:
+            if method == "auto":
+                f.write(f"{proxy.method}://")
             f.write(str(proxy) + "\n")
 
+    write_atomic(output, write_output)
+    if results is not None:
+        write_results(results, valid_proxies)
+    os.remove(journal_path)
+
     print(f"Found {len(valid_proxies)} valid proxies")
+    latencies = sorted(proxy.latency for proxy in valid_proxies if proxy.latency is not None)
+    if latencies:
+        print(f"Latency p50: {percentile(latencies, 50):.3f}s, p90: {percentile(latencies, 90):.3f}s, "
+              f"p99: {percentile(latencies, 99):.3f}s")
+    speeds = sorted(proxy.speed for proxy in valid_proxies if proxy.speed is not None)
+    if speeds:
+        print(f"Speed p10: {percentile(speeds, 10) / 1000:.1f} KB/s, p50: {percentile(speeds, 50) / 1000:.1f} KB/s, "
+              f"p90: {percentile(speeds, 90) / 1000:.1f} KB/s")
+    if anonymity is not None:
+        levels = [proxy.anonymity for proxy in valid_proxies]
+        print(", ".join(f"{levels.count(level)} {level}" for level in reversed(anonymity_levels)))
+
+
+def concurrency_type(value):
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a number or auto")
 
 
 def main():
@@ -123,8 +1623,10 @@ def main():
         help="Dismiss the proxy after -t seconds",
         default=20,
     )
-    parser.add_argument("-p", "--proxy", help="Check HTTPS, HTTP, SOCKS4, or SOCKS5 proxies", default="http")
+    parser.add_argument("-p", "--proxy", help="Check HTTPS, HTTP, SOCKS4, or SOCKS5 proxies, or auto to detect the protocol of each proxy",
+                        default="http")
     parser.add_argument("-l", "--list", help="Path to your proxy list file", default="output.txt")
+    parser.add_argument("-o", "--output", help="Save working proxies to this file instead of overwriting the list")
     parser.add_argument(
         "-s",
         "--site",
@@ -143,9 +1645,185 @@ def main():
         help="Use a random user agent per proxy",
         action="store_true",
     )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=concurrency_type,
+        help="Maximum number of proxies checked at the same time per worker, or auto to size it from the open "
+             "file limit and adjust it while running",
+        default="auto",
+    )
+    parser.add_argument(
+        "--prefilter",
+        choices=["connect"],
+        help="Drop proxies that do not accept a TCP connection before the full check",
+    )
+    parser.add_argument(
+        "--prefilter-timeout",
+        type=float,
+        help="Dismiss the proxy in the prefilter stage after this many seconds",
+        default=3,
+    )
+    parser.add_argument(
+        "--detect-timeout",
+        type=float,
+        help="Dismiss a protocol probe in auto mode after this many seconds",
+        default=5,
+    )
+    parser.add_argument(
+        "--db",
+        help="Path to a SQLite database that keeps the last check result of every proxy",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=int,
+        help="Reuse results from --db that are newer than this many seconds instead of rechecking",
+    )
+    parser.add_argument(
+        "--sort",
+        choices=["latency"],
+        help="Sort working proxies in the output, fastest first",
+    )
+    parser.add_argument(
+        "--results",
+        help="Also write latency details of working proxies to this file (.csv for CSV, JSON lines otherwise)",
+    )
+    parser.add_argument(
+        "--want",
+        type=int,
+        help="Stop as soon as this many proxies passed the check",
+    )
+    parser.add_argument(
+        "--fastest",
+        help="With --want, keep checking until the wanted number of lowest-latency proxies is certain",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Split the list across this many processes, each checking --concurrency proxies at a time",
+        default=1,
+    )
+    parser.add_argument(
+        "--adaptive-timeout",
+        help="Tighten the timeout to p95 of the latencies seen so far plus --timeout-margin",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--timeout-margin",
+        type=float,
+        help="Seconds added to p95 latency for the adaptive timeout",
+        default=1,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue an interrupted run from its journal, skipping proxies it already finished",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--probe",
+        choices=["full", "raw"],
+        help="full: fetch the site's response head (over TLS for HTTPS sites); raw: only check that the proxy "
+             "relays, by the status line of a plain GET or a granted tunnel",
+        default="full",
+    )
+    parser.add_argument(
+        "--subnet-limit",
+        type=int,
+        help="Check at most this many proxies of one /24 subnet at a time; other subnets fill the remaining "
+             "concurrency",
+    )
+    parser.add_argument(
+        "--host-limit",
+        type=int,
+        help="Check at most this many proxies of one IP address at a time",
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        help="Check this many proxies of every /24 subnet and port first, then handle subnets where all of them "
+             "failed according to --dead-subnets",
+    )
+    parser.add_argument(
+        "--dead-subnets",
+        choices=["skip", "defer"],
+        help="skip: drop the rest of a subnet whose samples all failed; defer: check it after everything else",
+        default="skip",
+    )
+    parser.add_argument(
+        "--speed-url",
+        help="Download this URL through every working proxy to measure its speed, e.g. "
+             "http://<judge host>:8899/bytes/1000000 (see proxy_judge)",
+    )
+    parser.add_argument(
+        "--speed-bytes",
+        type=int,
+        help="Stop the speed test download after this many bytes",
+        default=1000000,
+    )
+    parser.add_argument(
+        "--speed-timeout",
+        type=float,
+        help="Seconds a speed test may take; slower downloads are measured on what arrived in time",
+        default=10,
+    )
+    parser.add_argument(
+        "--min-speed",
+        type=float,
+        help="Drop proxies that download slower than this many KB/s in the speed test",
+    )
+    parser.add_argument(
+        "--anonymity",
+        choices=anonymity_levels,
+        help="Classify proxies against a judge given with -s (see proxy_judge) and keep those at least this anonymous",
+    )
+    parser.add_argument(
+        "--progress",
+        help="Print throughput, pass rate, ETA and latency every --stats-interval seconds",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="Rewrite run statistics as JSON to this file every --stats-interval seconds",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve run statistics in Prometheus text format on this local port",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        help="Seconds between two progress lines or stats file updates",
+        default=5,
+    )
     args = parser.parse_args()
-    check(file=args.list, timeout=args.timeout, method=args.proxy, site=args.site, verbose=args.verbose,
-          random_user_agent=args.random_agent)
+    if args.fastest and args.want is None:
+        parser.error("--fastest requires --want")
+    if args.max_age is not None and args.db is None:
+        parser.error("--max-age requires --db")
+    if args.min_speed is not None and args.speed_url is None:
+        parser.error("--min-speed requires --speed-url")
+    if args.anonymity is not None and args.probe == "raw":
+        parser.error("--anonymity cannot be used with --probe raw")
+    try:
+        check(file=args.list, timeout=args.timeout, method=args.proxy, site=args.site, verbose=args.verbose,
+              random_user_agent=args.random_agent, concurrency=args.concurrency, prefilter=args.prefilter,
+              prefilter_timeout=args.prefilter_timeout, detect_timeout=args.detect_timeout,
+              db=args.db, max_age=args.max_age, sort=args.sort, results=args.results,
+              want=args.want, fastest=args.fastest, workers=args.workers,
+              adaptive_timeout=args.adaptive_timeout, timeout_margin=args.timeout_margin, output=args.output,
+              resume=args.resume, progress=args.progress, stats_file=args.stats_file,
+              metrics_port=args.metrics_port, stats_interval=args.stats_interval, anonymity=args.anonymity,
+              probe=args.probe, sample=args.sample, dead_groups=args.dead_subnets,
+              subnet_limit=args.subnet_limit, host_limit=args.host_limit, speed_url=args.speed_url,
+              speed_bytes=args.speed_bytes, speed_timeout=args.speed_timeout,
+              min_speed=args.min_speed * 1000 if args.min_speed is not None else None)
+    except ValueError as e:
+        parser.error(str(e))
+    except KeyboardInterrupt:
+        sys.exit(130)
 
 
 if __name__ == "__main__":
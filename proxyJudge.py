@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import re
+from urllib.parse import urlsplit
+
+# Big enough for any real request head, small enough that a stray client cannot hog memory
+max_head_size = 16384
+
+# Speed test payloads: GET /bytes/<size> answers with that many bytes, up to this cap
+bytes_pattern = re.compile(r"/bytes/(\d+)$")
+max_payload_size = 100000000
+payload_chunk = b"\0" * 65536
+
+
+def judge_response(remote_address, head):
+    # Echoes the address the request came from and every request header, in a few hundred bytes
+    lines = head.decode("latin-1").split("\r\n")[1:]
+    body = f"REMOTE_ADDR: {remote_address}\r\n" + "".join(line + "\r\n" for line in lines if line)
+    body = body.encode("latin-1")
+    return (b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n"
+            b"\r\n" + body)
+
+
+async def send_payload(writer, size):
+    writer.write(b"HTTP/1.1 200 OK\r\n"
+                 b"Content-Type: application/octet-stream\r\n"
+                 b"Content-Length: " + str(size).encode() + b"\r\n"
+                 b"Connection: close\r\n"
+                 b"\r\n")
+    while size > 0:
+        writer.write(payload_chunk[:size])
+        size -= len(payload_chunk)
+        await writer.drain()
+
+
+async def handle(reader, writer):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        # Proxies relaying plain HTTP send the absolute URI
+        parts = head.split(b" ", 2)
+        match = bytes_pattern.match(urlsplit(parts[1].decode("latin-1")).path) if len(parts) > 2 else None
+        if match is not None:
+            await send_payload(writer, min(int(match.group(1)), max_payload_size))
+        else:
+            writer.write(judge_response(writer.get_extra_info("peername")[0], head[:-4]))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle, host, port, limit=max_head_size, backlog=4096)
+    print(f"Judge listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        help="Address to listen on",
+        default="0.0.0.0",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on",
+        default=8899,
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
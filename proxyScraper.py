@@ -1,15 +1,478 @@
 import argparse
 import asyncio
+import codecs
+import hashlib
+import html
+import json
+import os
+import pickle
 import platform
 import re
 import sys
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import httpx
-from bs4 import BeautifulSoup
+
+
+class ResponseCache:
+    # Keeps source bodies on disk with their ETag/Last-Modified, so unchanged sources answer 304
+    # and neither the download nor the parse is repeated. Entries used least recently go first
+    # once the directory grows past max_size bytes
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url, suffix):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest() + suffix)
+
+    def entry(self, url):
+        if url not in self.entries:
+            try:
+                with open(self.path(url, ".json")) as f:
+                    self.entries[url] = json.load(f)
+            except (OSError, ValueError):
+                self.entries[url] = None
+        return self.entries[url]
+
+    def conditional_headers(self, url):
+        entry = self.entry(url)
+        headers = {}
+        if entry is None or not os.path.exists(self.path(url, ".body")):
+            return headers
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def open_body(self, url):
+        # None when the body was evicted, possibly by another run, since the request was sent
+        try:
+            return open(self.path(url, ".body"), "rb")
+        except FileNotFoundError:
+            return None
+
+    def begin(self, url, response):
+        # Returns a file for the body to be written to as it arrives, or None when it is not worth keeping
+        if response.status_code != 200:
+            return None
+        if not response.headers.get("ETag") and not response.headers.get("Last-Modified"):
+            # Nothing to revalidate against
+            self.entries[url] = None
+            return None
+        return tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False)
+
+    def commit(self, url, response, body):
+        os.replace(body.name, self.path(url, ".body"))
+        content_type = response.headers.get("Content-Type")
+        self.entries[url] = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "encoding": response.charset_encoding,
+            "headers": {"Content-Type": content_type} if content_type else {},
+            "parsed": {},
+        }
+
+    def discard(self, body):
+        # Whatever was not committed, a body cut short by an error or a cancelled download
+        body.close()
+        if os.path.exists(body.name):
+            os.remove(body.name)
+
+    def encoding(self, url):
+        return self.entry(url).get("encoding")
+
+    def parsed(self, url, key):
+        entry = self.entry(url)
+        return entry["parsed"].get(key) if entry is not None else None
+
+    def remember(self, url, key, proxies):
+        entry = self.entry(url)
+        if entry is not None:
+            entry["parsed"][key] = proxies
+
+    def save(self):
+        for url, entry in self.entries.items():
+            if entry is None:
+                for suffix in (".json", ".body"):
+                    try:
+                        os.remove(self.path(url, suffix))
+                    except OSError:
+                        pass
+                continue
+            # Rewriting the entry also marks it as recently used
+            temp = self.path(url, ".json.tmp")
+            with open(temp, "w") as f:
+                json.dump(entry, f)
+            os.replace(temp, self.path(url, ".json"))
+        self.evict()
+
+    def evict(self):
+        files = []
+        names = set(os.listdir(self.directory))
+        for name in names:
+            if name.endswith(".json"):
+                index = os.path.join(self.directory, name)
+                body = index[:-len(".json")] + ".body"
+                try:
+                    size = os.path.getsize(index) + (os.path.getsize(body) if os.path.exists(body) else 0)
+                    files.append((os.path.getmtime(index), size, index, body))
+                except OSError:
+                    pass
+            elif name.endswith(".body") and name[:-len(".body")] + ".json" not in names:
+                # Committed by a run that stopped before writing its index, so nothing can revalidate it
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        total = sum(size for _, size, _, _ in files)
+        for _, size, index, body in sorted(files):
+            if total <= self.max_size:
+                break
+            for path in (index, body):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+class Scanner:
+    # Finds matches of a bytes pattern in a body fed chunk by chunk. Only the last `overlap` bytes
+    # (at least the longest possible match) are carried over, so a match cut by a chunk boundary
+    # is found whole in the next round while memory stays bounded
+
+    done = False
+
+    def __init__(self, pattern, overlap):
+        self.pattern = pattern
+        self.overlap = overlap
+        self.buffer = b""
+
+    def feed(self, chunk):
+        buffer = self.buffer + chunk
+        # Matches starting before this point end inside the buffer, whatever comes next
+        limit = len(buffer) - self.overlap
+        end = 0
+        proxies = []
+        for match in self.pattern.finditer(buffer):
+            if match.start() >= limit:
+                break
+            proxies.append(match.group().decode())
+            end = match.end()
+        self.buffer = buffer[max(end, limit, 0):]
+        return proxies
+
+    def close(self):
+        proxies = [proxy.decode() for proxy in self.pattern.findall(self.buffer)]
+        self.buffer = b""
+        return proxies
+
+
+# Elements that never have an end tag
+void_elements = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source",
+                 "track", "wbr"}
+tag_pattern = re.compile(r"<(/?)([A-Za-z][^\s/>]*)([^>]*)>")
+class_pattern = re.compile(r"""\bclass\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.I)
+raw_text_ends = {
+    "script": re.compile(r"</script\s*>", re.I),
+    "style": re.compile(r"</style\s*>", re.I),
+}
+
+
+class TableScanner:
+    # Pulls proxies out of the rows of the first `container` element of a page fed chunk by chunk.
+    # Tags are found with a regex and only the elements open inside the container are tracked, so
+    # no document tree is built, and the rest of the page is skipped once the container is closed.
+    # Specs are (tag, class) pairs, the class being None for any element of that tag
+
+    def __init__(self, container, row, cell, columns, pattern, encoding=None):
+        self.container = container
+        self.row = row
+        self.cell = cell
+        self.columns = columns
+        self.pattern = pattern
+        self.encoding = encoding or "utf-8"
+        self.decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+        self.buffer = ""
+        # Open elements from the container down, each a [tag, cells of a row or None]
+        self.stack = []
+        # Position in the stack and raw text of the open cell
+        self.cell_at = None
+        self.text = []
+        self.done = False
+        self.proxies = []
+
+    def __getstate__(self):
+        # Decoders of the CJK codecs cannot be pickled, so parse workers rebuild the decoder from
+        # its state, the bytes of a character cut by the end of the last chunk
+        state = self.__dict__.copy()
+        state["decoder"] = self.decoder.getstate()
+        return state
+
+    def __setstate__(self, state):
+        decoder_state = state.pop("decoder")
+        self.__dict__.update(state)
+        self.decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+        self.decoder.setstate(decoder_state)
+
+    @staticmethod
+    def matches(tag, attributes, spec):
+        name, class_name = spec
+        if tag != name:
+            return False
+        if class_name is None:
+            return True
+        match = class_pattern.search(attributes)
+        classes = html.unescape(next(group for group in match.groups() if group is not None)) if match else ""
+        return classes == class_name or class_name in classes.split()
+
+    def start(self, tag, attributes):
+        if not self.stack:
+            if self.matches(tag, attributes, self.container):
+                self.stack.append([tag, None])
+            return
+        # Inside a table nested in a cell everything is text of that cell
+        nested = self.cell_at is not None and any(name == self.container[0]
+                                                  for name, _ in self.stack[self.cell_at + 1:])
+        if not nested and self.matches(tag, attributes, self.cell) and any(cells is not None
+                                                                         for _, cells in self.stack):
+            if self.cell_at is not None:
+                # An unclosed cell ends where the next one starts
+                self.close_elements(self.cell_at)
+            self.stack.append([tag, None])
+            self.cell_at = len(self.stack) - 1
+            self.text = []
+        elif not nested and tag == self.row and (self.cell_at is None or self.cell[0] != self.row):
+            if self.cell_at is not None:
+                # And an unclosed row where the next one starts, unless cells are of the row's tag too
+                self.close_elements(max(i for i, (_, cells) in enumerate(self.stack) if cells is not None))
+            self.stack.append([tag, []])
+        else:
+            self.stack.append([tag, None])
+
+    def end(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                self.close_elements(i)
+                break
+
+    def close_elements(self, start):
+        while len(self.stack) > start:
+            at = len(self.stack) - 1
+            tag, cells = self.stack.pop()
+            if at == self.cell_at:
+                self.cell_at = None
+                for _, row_cells in reversed(self.stack):
+                    if row_cells is not None:
+                        row_cells.append(html.unescape("".join(self.text)).strip())
+                        break
+            elif cells is not None and len(cells) > max(self.columns):
+                proxy = ":".join(cells[column] for column in self.columns)
+                self.proxies.extend(match.decode() for match in self.pattern.findall(proxy.encode()))
+        if not self.stack:
+            self.done = True
+
+    def scan(self, final):
+        # Consumes the buffer up to the first tag, comment or script that is not complete yet
+        text = self.buffer
+        position = 0
+        while not self.done:
+            start = text.find("<", position)
+            if start < 0:
+                start = len(text)
+            if self.cell_at is not None and start > position:
+                self.text.append(text[position:start])
+            position = start
+            if start == len(text):
+                break
+            if text.startswith("<!--", start):
+                end = text.find("-->", start + 4)
+                if end < 0:
+                    break
+                position = end + 3
+                continue
+            match = tag_pattern.match(text, start)
+            if match is None:
+                end = text.find(">", start)
+                if end < 0:
+                    break
+                if text[start + 1] in "!?/":
+                    # Doctype, processing instruction or a broken end tag
+                    position = end + 1
+                else:
+                    if self.cell_at is not None:
+                        self.text.append("<")
+                    position = start + 1
+                continue
+            closing, tag, attributes = match.groups()
+            tag = tag.lower()
+            if closing:
+                self.end(tag)
+            elif tag in raw_text_ends:
+                # Script and style contents are not text of the page
+                end = raw_text_ends[tag].search(text, match.end())
+                if end is None:
+                    break
+                position = end.end()
+                continue
+            elif tag not in void_elements:
+                self.start(tag, attributes)
+                if attributes.endswith("/"):
+                    self.end(tag)
+            position = match.end()
+        self.buffer = "" if final or self.done else text[position:]
+
+    def feed(self, chunk):
+        if not self.done:
+            self.buffer += self.decoder.decode(chunk)
+            self.scan(False)
+        proxies, self.proxies = self.proxies, []
+        return proxies
+
+    def close(self):
+        if not self.done:
+            self.buffer += self.decoder.decode(b"", final=True)
+            self.scan(True)
+            if self.stack:
+                self.close_elements(0)
+        proxies, self.proxies = self.proxies, []
+        return proxies
+
+
+# Bytes a scanner is handed at a time, large enough that shipping them to a parse worker is cheap
+# next to scanning them
+scan_block_size = 262144
+
+
+def scan_block(scanner, block, final=False):
+    # Runs in a parse worker; the scanner travels with its state and comes back with it
+    proxies = scanner.feed(block)
+    if final:
+        proxies += scanner.close()
+    return scanner, proxies
+
+
+class Sources:
+    # Every URL is downloaded once for all the scraper classes reading it, each class scanning the
+    # body as it streams in, in `executor` when there is one. Scrapers of the same class share one
+    # parse, which each of them narrows to its method with select()
+
+    def __init__(self, client, cache=None, executor=None):
+        self.client = client
+        self.cache = cache
+        self.executor = executor
+        self.downloads = {}
+        self.parses = {}
+
+    async def scan(self, scanner, block, final=False):
+        # Off the event loop, so other sources keep downloading while this one is parsed
+        if self.executor is None:
+            return scan_block(scanner, block, final)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, scan_block, scanner, block,
+                                                                    final)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # A scanner that cannot be sent to a worker, one with some other codec's decoder, is run here
+            return scan_block(scanner, block, final)
+
+    async def feed(self, scanners, found, block):
+        names = [name for name, scanner in scanners.items() if not scanner.done]
+        results = await asyncio.gather(*[self.scan(scanners[name], block) for name in names])
+        for name, (scanner, proxies) in zip(names, results):
+            scanners[name] = scanner
+            found[name].extend(proxies)
+
+    async def stream(self, scrapers, url, revalidate=True):
+        # Returns what each scraper class found, never holding more of the body than a block
+        found = {name: [] for name in scrapers}
+        scanners = {}
+        missing = False
+        headers = self.cache.conditional_headers(url) if self.cache is not None and revalidate else {}
+        async with self.client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and self.cache is not None:
+                for name, scraper in scrapers.items():
+                    proxies = self.cache.parsed(url, name)
+                    if proxies is not None:
+                        found[name] = proxies
+                    else:
+                        scanners[name] = scraper.scanner(self.cache.encoding(url))
+                body = self.cache.open_body(url) if scanners else None
+                if body is not None:
+                    with body:
+                        for block in iter(lambda: body.read(scan_block_size), b""):
+                            await self.feed(scanners, found, block)
+                            if all(scanner.done for scanner in scanners.values()):
+                                break
+                elif scanners:
+                    missing = True
+            else:
+                scanners = {name: scraper.scanner(response.charset_encoding) for name, scraper in scrapers.items()}
+                body = self.cache.begin(url, response) if self.cache is not None else None
+                try:
+                    async for block in response.aiter_bytes(scan_block_size):
+                        if body is not None:
+                            body.write(block)
+                        await self.feed(scanners, found, block)
+                        # The rest of the page is only worth downloading for the cache
+                        if body is None and all(scanner.done for scanner in scanners.values()):
+                            break
+                    if body is not None:
+                        body.close()
+                        self.cache.commit(url, response, body)
+                finally:
+                    if body is not None:
+                        self.cache.discard(body)
+        if missing:
+            # Nothing left to scan for this 304, so the page is downloaded again in full
+            return await self.stream(scrapers, url, revalidate=False)
+        # What is left is at most an incomplete tag or match, not worth a trip to a worker
+        for name, scanner in scanners.items():
+            _, proxies = scan_block(scanner, b"", final=True)
+            found[name].extend(proxies)
+        return found
+
+    async def download(self, url):
+        scrapers, results = self.downloads.pop(url)
+        try:
+            found = await self.stream(scrapers, url)
+        except Exception as e:
+            results.set_exception(e)
+            return
+        if self.cache is not None:
+            for name, proxies in found.items():
+                self.cache.remember(url, name, proxies)
+        results.set_result(found)
+
+    async def parse(self, scraper, url):
+        # Scrapers started together all join the download before it begins; one asking for the URL
+        # after that starts another
+        name = type(scraper).__name__
+        if url not in self.downloads:
+            self.downloads[url] = ({}, asyncio.get_running_loop().create_future())
+            asyncio.ensure_future(self.download(url))
+        scrapers, results = self.downloads[url]
+        scrapers[name] = scraper
+        return (await results)[name]
+
+    async def extract(self, scraper):
+        url = scraper.get_url()
+        key = (type(scraper).__name__, url)
+        if key not in self.parses:
+            self.parses[key] = asyncio.ensure_future(self.parse(scraper, url))
+        return await self.parses[key]
 
 
 class Scraper:
+    pattern = re.compile(rb"\d{1,3}(?:\.\d{1,3}){3}(?::\d{1,5})?")
+    # Longer than any match of pattern, see Scanner
+    overlap = 64
 
     def __init__(self, method, _url):
         self.method = method
@@ -18,17 +481,18 @@ class Scraper:
     def get_url(self, **kwargs):
         return self._url.format(**kwargs, method=self.method)
 
-    async def get_response(self, client):
-        return await client.get(self.get_url())
+    def scanner(self, encoding):
+        return Scanner(self.pattern, self.overlap)
+
+    def select(self, proxies):
+        # Narrows what was parsed from a source, shared by every scraper reading it, to this scraper
+        return proxies
 
-    async def handle(self, response):
-        return response.text
+    async def scrape_page(self, sources):
+        return self.select(await sources.extract(self))
 
-    async def scrape(self, client):
-        response = await self.get_response(client)
-        proxies = await self.handle(response)
-        pattern = re.compile(r"\d{1,3}(?:\.\d{1,3}){3}(?::\d{1,5})?")
-        return re.findall(pattern, proxies)
+    async def scrape(self, sources):
+        return await self.scrape_page(sources)
 
 
 # From spys.me
@@ -88,56 +552,38 @@ class ProxyListDownloadScraper(Scraper):
         return super().get_url(anon=self.anon, **kwargs)
 
 
+# For websites listing proxies in a table, described by where the rows and cells are
+class TableScraper(Scraper):
+    container = ("table", None)
+    row = "tr"
+    cell = ("td", None)
+    # Cells joined with ":" into a proxy
+    columns = (0,)
+
+    def scanner(self, encoding):
+        return TableScanner(self.container, self.row, self.cell, self.columns, self.pattern, encoding)
+
+
 # For websites using table in html
-class GeneralTableScraper(Scraper):
-
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("table", attrs={"class": "table table-striped table-bordered"})
-        for row in table.findAll("tr"):
-            count = 0
-            proxy = ""
-            for cell in row.findAll("td"):
-                if count == 1:
-                    proxy += ":" + cell.text.replace("&nbsp;", "")
-                    proxies.add(proxy)
-                    break
-                proxy += cell.text.replace("&nbsp;", "")
-                count += 1
-        return "\n".join(proxies)
+class GeneralTableScraper(TableScraper):
+    container = ("table", "table table-striped table-bordered")
+    columns = (0, 1)
 
 
 # For websites using div in html
-class GeneralDivScraper(Scraper):
-
-    async def handle(self, response):
-        soup = BeautifulSoup(response.text, "html.parser")
-        proxies = set()
-        table = soup.find("div", attrs={"class": "list"})
-        for row in table.findAll("div"):
-            count = 0
-            proxy = ""
-            for cell in row.findAll("div", attrs={"class": "td"}):
-                if count == 2:
-                    break
-                proxy += cell.text+":"
-                count += 1
-            proxy = proxy.rstrip(":")
-            proxies.add(proxy)
-        return "\n".join(proxies)
-    
+class GeneralDivScraper(TableScraper):
+    container = ("div", "list")
+    row = "div"
+    cell = ("div", "td")
+    columns = (0, 1)
+
 # For scraping live proxylist from github
 class GitHubScraper(Scraper):
-        
-    async def handle(self, response):
-        tempproxies = response.text.split("\n")
-        proxies = set()
-        for prxy in tempproxies:
-            if self.method in prxy:
-                proxies.add(prxy.split("//")[-1])
+    # Keeps the scheme in front of every proxy, so one parse of a list serves every method
+    pattern = re.compile(rb"[A-Za-z0-9]{1,10}://\d{1,3}(?:\.\d{1,3}){3}(?::\d{1,5})?")
 
-        return "\n".join(proxies)
+    def select(self, proxies):
+        return [proxy.split("//")[-1] for proxy in proxies if self.method in proxy]
 
 
 scrapers = [
@@ -171,7 +617,7 @@ def verbose_print(verbose, message):
     if verbose:
         print(message)
 
-async def scrape(method, output, verbose):
+async def scrape(method, output, verbose, cache_dir=None, cache_size=50000000, parse_workers=0):
     now = time.time()
     methods = [method]
     if method == "socks":
@@ -184,11 +630,13 @@ async def scrape(method, output, verbose):
 
     tasks = []
     client = httpx.AsyncClient(follow_redirects=True)
+    executor = ProcessPoolExecutor(parse_workers) if parse_workers else None
+    sources = Sources(client, ResponseCache(cache_dir, cache_size) if cache_dir else None, executor)
 
     async def scrape_scraper(scraper):
         try:
             verbose_print(verbose, f"Looking {scraper.get_url()}...")
-            proxies.extend(await scraper.scrape(client))
+            proxies.extend(await scraper.scrape(sources))
         except Exception:
             pass
 
@@ -197,6 +645,10 @@ async def scrape(method, output, verbose):
 
     await asyncio.gather(*tasks)
     await client.aclose()
+    if executor is not None:
+        executor.shutdown()
+    if sources.cache is not None:
+        sources.cache.save()
 
     proxies = set(proxies)
     verbose_print(verbose, f"Writing {len(proxies)} proxies to file...")
@@ -225,17 +677,35 @@ def main():
         help="Increase output verbosity",
         action="store_true",
     )
+    parser.add_argument(
+        "--cache",
+        help="Directory keeping source responses between runs; unchanged sources are revalidated instead of downloaded",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        help="Size cap of the cache directory in MB, least recently used sources are evicted first",
+        default=50,
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        help="Processes parsing downloaded pages while others download, 0 parses in the main process",
+        default=os.cpu_count() or 1,
+    )
     args = parser.parse_args()
+    run = scrape(args.proxy, args.output, args.verbose, args.cache, int(args.cache_size * 1000000),
+                 args.parse_workers)
 
     if sys.version_info >= (3, 7) and platform.system() == 'Windows':
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(scrape(args.proxy, args.output, args.verbose))
+        loop.run_until_complete(run)
         loop.close()
     elif sys.version_info >= (3, 7):
-        asyncio.run(scrape(args.proxy, args.output, args.verbose))
+        asyncio.run(run)
     else:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(scrape(args.proxy, args.output, args.verbose))
+        loop.run_until_complete(run)
         loop.close()
 
 if __name__ == "__main__":
@@ -3,16 +3,15 @@ from setuptools import setup
 setup(
     name='proxyz',
     version='0.2.0',
-    py_modules=['proxyScraper', 'proxyChecker'],
+    py_modules=['proxyScraper', 'proxyChecker', 'proxyJudge'],
     install_requires=[
         'httpx',
-        'beautifulsoup4',
-        'pysocks',
     ],
     entry_points={
         'console_scripts': [
             'proxy_scraper=proxyScraper:main',
             'proxy_checker=proxyChecker:main',
+            'proxy_judge=proxyJudge:main',
         ],
     },
     include_package_data=True,